@@ -1,15 +1,39 @@
-from fastapi import FastAPI, Request, Query
+from fastapi import FastAPI, Request, Response, Query
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-import os, json, logging, asyncio, re, sqlite3
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+import os, logging, asyncio, re, sqlite3, random, time, uuid, gzip, threading
 import httpx
-from datetime import datetime, timedelta, date
-from contextlib import contextmanager
-from pydantic import BaseModel
+import orjson
+from types import MappingProxyType
+from datetime import datetime, date, timezone
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager, asynccontextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from pydantic import BaseModel, ValidationError
 from typing import List, Optional
 
 
-app = FastAPI(title="Atende Med – Integração TENEX → MEDICAR (async)")
+class OrjsonResponse(JSONResponse):
+    """Respostas JSON serializadas com orjson (mantém UTF-8 sem escapes)."""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Startup/shutdown do app (app_iniciar/app_encerrar, definidos mais abaixo)."""
+    await app_iniciar()
+    try:
+        yield
+    finally:
+        await app_encerrar()
+
+app = FastAPI(
+    title="Atende Med – Integração TENEX → MEDICAR (async)",
+    default_response_class=OrjsonResponse,
+    lifespan=lifespan,
+)
 
 # Servir arquivos estáticos (painel admin)
 _static_dir = os.path.join(os.path.dirname(__file__), "static")
@@ -25,11 +49,27 @@ log = logging.getLogger("atendmed-api")
 # ============================================================
 # UTIL
 # ============================================================
+_NON_DIGITS_RE = re.compile(r"\D")
+# str.translate que remove tudo que não é dígito ASCII (caminho rápido p/ CPFs)
+_ASCII_NON_DIGITS = str.maketrans("", "", "".join(chr(c) for c in range(128) if not 48 <= c <= 57))
+
+@lru_cache(maxsize=2048)  # o mesmo CPF é normalizado várias vezes por item
 def only_digits(s: str) -> str:
-    return re.sub(r"\D", "", s or "")
+    s = s or ""
+    if s.isascii():
+        if s.isdigit():  # já limpo (ex.: CPF vindo da Medicar)
+            return s
+        return s.translate(_ASCII_NON_DIGITS)
+    return _NON_DIGITS_RE.sub("", s)
 
+@lru_cache(maxsize=4096)  # nomes se repetem entre titular/dependentes/reprocessamentos
 def only_ascii_upper(s: str) -> str:
-    return (s or "").encode("ascii", errors="ignore").decode().upper().strip()
+    s = s or ""
+    if not s.isascii():
+        s = s.encode("ascii", errors="ignore").decode()
+    elif s.isupper() or not s:
+        return s.strip()
+    return s.upper().strip()
 
 def valid_date_or_today(s: str | None) -> str:
     """Valida se s está no formato yyyy-mm-dd. Se não, retorna a data de hoje."""
@@ -41,11 +81,47 @@ def valid_date_or_today(s: str | None) -> str:
             log.warning(f"[DATA] Valor inválido para blockDate: '{s}' → usando data de hoje")
     return date.today().strftime("%Y-%m-%d")
 
+# ============================================================
+# MODELOS
+# ============================================================
+@dataclass(slots=True, frozen=True)
+class Pessoa:
+    """
+    Titular ou dependente enviado à Medicar (PLIncBenModel).
+    Já normalizado na construção: nome/mãe em ASCII maiúsculo, CPF só dígitos.
+    """
+    nome: str
+    cpf: str
+    data_nascimento: str
+    sexo: str
+    nome_mae: str = "NOME MAE NAO INFORMADO"
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Pessoa":
+        return cls(
+            nome=only_ascii_upper(d.get("nome") or ""),
+            cpf=only_digits(d.get("cpf") or ""),
+            data_nascimento=d.get("data_nascimento") or "",
+            sexo=str(d.get("sexo") or "2"),
+            nome_mae=only_ascii_upper(d.get("nome_mae") or "NOME MAE NAO INFORMADO"),
+        )
+
+    @classmethod
+    def from_contato(cls, c: dict) -> "Pessoa":
+        """A partir de um contato TENEX (data com hífens, sexo em `genero`)."""
+        return cls(
+            nome=only_ascii_upper(c.get("nome") or ""),
+            cpf=only_digits(c.get("cpf") or ""),
+            data_nascimento=(c.get("data_nascimento") or "").replace("-", ""),
+            sexo=str(c.get("genero") or "2"),
+        )
+
 # ============================================================
 # CONFIG
 # ============================================================
 TENEX_BASE_URL = os.getenv("TENEX_BASE_URL", "https://maisaudebh.tenex.com.br").rstrip("/")
 TENEX_BASIC_AUTH = os.getenv("TENEX_BASIC_AUTH")
+TENEX_HEADERS = MappingProxyType({"Authorization": f"Basic {TENEX_BASIC_AUTH}"})
 
 MEDICAR_BASE_URL = os.getenv("MEDICAR_BASE_URL", "").rstrip("/")
 MEDICAR_USERNAME = os.getenv("MEDICAR_USERNAME")
@@ -57,29 +133,167 @@ MEDICAR_CONTRATO = os.getenv("MEDICAR_CONTRATO")
 
 TENANT_ID = os.getenv("TENANT_ID")
 
-MEDICAR_CONTRACT_FIELDS_JSON = os.getenv("MEDICAR_CONTRACT_FIELDS_JSON", "")
-
-PLAN_MAPPING_JSON = json.loads(os.getenv(
-    "PLAN_MAPPING_JSON",
-    '{"31":{"codpro":"0066","versao":"001"},"32":{"codpro":"0066","versao":"001"}}'
-))
+def load_json_env(name: str, default: str = "", obrigatorio: bool = False):
+    """
+    Lê uma variável de ambiente JSON (objeto) uma única vez. Vazia → None, ou
+    erro com obrigatorio=True. Preenchida com JSON inválido ou que não seja
+    objeto derruba o import (deploy com config quebrada falha na subida, não
+    em cada item).
+    """
+    raw = os.getenv(name, default)
+    if not raw:
+        if obrigatorio:
+            raise ValueError(f"[CONFIG] {name} vazio")
+        return None
+    try:
+        valor = orjson.loads(raw)
+    except orjson.JSONDecodeError as e:
+        raise ValueError(f"[CONFIG] {name} não é um JSON válido: {e}") from e
+    if not isinstance(valor, dict):
+        raise ValueError(f"[CONFIG] {name} deve ser um objeto JSON")
+    return valor
+
+CONTRACT_FIELDS = load_json_env("MEDICAR_CONTRACT_FIELDS_JSON")
+
+# somente leitura: compartilhado por todos os itens/requisições
+def _plan_key(k):
+    """id_plano TENEX como chave: inteiro quando numérico ("31" e 31 → 31)."""
+    return int(k) if isinstance(k, str) and k.isdigit() else k
+
+PLAN_MAPPING_JSON = MappingProxyType({
+    _plan_key(k): v
+    for k, v in (load_json_env(
+        "PLAN_MAPPING_JSON",
+        '{"31":{"codpro":"0066","versao":"001"},"32":{"codpro":"0066","versao":"001"}}',
+        obrigatorio=True
+    )).items()
+})
+
+# connect curto (socket morto falha rápido e cai no retry); leitura mantém 25 s
+HTTP_TIMEOUT = httpx.Timeout(25.0, connect=3.0, write=10.0, pool=5.0)
+# HEAD periódico em MEDICAR/TENEX para manter conexões abertas no pool
+# (0 = desligado; use menos que o keepalive_expiry do client, 30 s)
+HTTP_AQUECER_INTERVALO = float(os.getenv("HTTP_AQUECER_INTERVALO", "0"))
+MEDICAR_RESPOSTA_MAX = 64 * 1024  # acima disso a resposta de sucesso da Medicar não é parseada
+# Compressão gzip do corpo enviado à Medicar (desligada por padrão: nem todo
+# servidor aceita Content-Encoding na requisição)
+MEDICAR_GZIP_REQUEST = os.getenv("MEDICAR_GZIP_REQUEST", "0") == "1"
+MEDICAR_GZIP_MIN = 2048  # bytes
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "8"))  # itens do webhook processados em paralelo
+# Modo assíncrono dos webhooks: responde 202 na hora e processa os itens numa
+# fila com WEBHOOK_CONCURRENCY workers (desligado: resposta com os resultados)
+WEBHOOK_ASSINCRONO = os.getenv("WEBHOOK_ASSINCRONO", "0") == "1"
+WEBHOOK_FILA_MAX = int(os.getenv("WEBHOOK_FILA_MAX", "1000"))  # itens aguardando; cheia → 503
+WEBHOOK_FILA_DRENAR_MAX = float(os.getenv("WEBHOOK_FILA_DRENAR_MAX", "20"))  # s esperando a fila no shutdown
+# novo-cliente: sem plano na 1ª consulta → 202 e espera em background (job).
+# Desligado: a requisição fica aberta durante a espera pelo plano
+WEBHOOK_PENDENTES_BACKGROUND = os.getenv("WEBHOOK_PENDENTES_BACKGROUND", "0") == "1"
+# Chamadas simultâneas por upstream (somando todos os webhooks/lotes em andamento);
+# separados para um TENEX lento não segurar as chamadas à Medicar
+MEDICAR_CONCURRENCY = int(os.getenv("MEDICAR_CONCURRENCY", "16"))
+TENEX_CONCURRENCY = int(os.getenv("TENEX_CONCURRENCY", "16"))
+
+# Espera pelo plano na carteira TENEX (novo cliente): backoff exponencial + jitter
+# A espera termina pelo tempo (ESPERA_MAX); TENTATIVAS > 0 limita também o nº de consultas
+TENEX_PLANO_TENTATIVAS = int(os.getenv("TENEX_PLANO_TENTATIVAS", "0"))
+TENEX_PLANO_DELAY_BASE = float(os.getenv("TENEX_PLANO_DELAY_BASE", "5"))
+TENEX_PLANO_DELAY_MAX = 60.0
+TENEX_PLANO_ESPERA_MAX = float(os.getenv("TENEX_PLANO_ESPERA_MAX", "155"))  # espera total (s), SLA anterior
+
+def _tenex_plano_espera_total(tentativas: int) -> float:
+    """Soma das esperas (sem jitter) entre `tentativas` consultas, limitada a ESPERA_MAX."""
+    total = sum(min(TENEX_PLANO_DELAY_MAX, TENEX_PLANO_DELAY_BASE * 2 ** min(t - 1, 16))
+                for t in range(1, tentativas))
+    return min(total, TENEX_PLANO_ESPERA_MAX)
+
+# O tempo é o limite real da espera: falha no import se a configuração não chega lá
+if TENEX_PLANO_DELAY_BASE <= 0 or TENEX_PLANO_ESPERA_MAX <= 0:
+    raise ValueError("TENEX_PLANO_DELAY_BASE e TENEX_PLANO_ESPERA_MAX devem ser maiores que zero")
+if TENEX_PLANO_TENTATIVAS > 0 and _tenex_plano_espera_total(TENEX_PLANO_TENTATIVAS) < TENEX_PLANO_ESPERA_MAX:
+    raise ValueError(
+        f"TENEX_PLANO_TENTATIVAS={TENEX_PLANO_TENTATIVAS} esgota antes de TENEX_PLANO_ESPERA_MAX="
+        f"{TENEX_PLANO_ESPERA_MAX:.0f} s (espera {_tenex_plano_espera_total(TENEX_PLANO_TENTATIVAS):.0f} s); "
+        f"use 0 (sem limite) ou mais tentativas"
+    )
+# Carteira vazia ([] — CPF sem carteira nenhuma, não só sem plano) nesse número
+# de consultas seguidas → desiste antes do fim da espera. 0 = desligado: logo
+# após o cadastro o TENEX ainda pode devolver [] para um cliente que terá plano
+TENEX_CARTEIRA_VAZIA_MAX = int(os.getenv("TENEX_CARTEIRA_VAZIA_MAX", "0"))
+_token_cache = {"token": None, "expiry": 0.0, "refresh_at": 0.0}  # instantes em time.monotonic()
+TOKEN_REFRESH_MARGIN = 120  # renova em background a partir de (expiração - margem)
+_token_lock = asyncio.Lock()  # uma única renovação de token por vez
+
+# Contrato padrão (tenantid etc.) muda raramente → cache em memória
+CONTRACT_CACHE_TTL = int(os.getenv("CONTRACT_CACHE_TTL", "3600"))
+_contract_cache = {"data": None, "expiry": 0.0}
+_contract_lock = asyncio.Lock()
+_tenant_cache = {"tenantid": TENANT_ID}  # TENANT_ID ou o do contrato padrão (sem TTL)
+
+# Carteira TENEX por CPF (só guarda respostas COM plano; webhooks repetidos
+# do mesmo CPF não voltam ao TENEX enquanto o cache vale)
+CARTEIRA_CACHE_TTL = int(os.getenv("CARTEIRA_CACHE_TTL", "300"))
+CARTEIRA_CACHE_MAX = 10_000
+_carteira_cache: dict[str, tuple[float, list]] = {}
+_carteira_locks: dict[str, list] = {}  # lock_por_chave: [lock, nº de usuários] por CPF
+_carteira_validadores: dict[str, dict] = {}  # ETag/Last-Modified de carteiras ainda sem plano
+
+# Contrato (BBA_MATRIC/tenantid) por CPF — a matrícula não muda depois de criada;
+# só guarda respostas COM matrícula e é descartado ao cancelar
+MATRICULA_CACHE_TTL = int(os.getenv("MATRICULA_CACHE_TTL", "600"))
+MATRICULA_CACHE_MAX = 10_000
+_matricula_cache: dict[str, tuple[float, dict]] = {}
+
+# Itens do mesmo cliente (data.id) rodam um de cada vez, na ordem de chegada;
+# clientes diferentes continuam em paralelo
+_cliente_locks: dict[str, list] = {}
+
+@asynccontextmanager
+async def lock_por_chave(locks: dict[str, list], chave: str):
+    """
+    asyncio.Lock por chave, guardado como [lock, nº de usuários]. A entrada só
+    sai do dict quando ninguém mais segura nem espera o lock.
+    """
+    entrada = locks.get(chave)
+    if entrada is None:
+        entrada = locks[chave] = [asyncio.Lock(), 0]
+    entrada[1] += 1
+    try:
+        async with entrada[0]:
+            yield
+    finally:
+        entrada[1] -= 1
+        if entrada[1] == 0:
+            del locks[chave]
 
-HTTP_TIMEOUT = 25.0
-_token_cache = {"token": None, "expiry": datetime.min}
+def cliente_lock(item: dict):
+    return lock_por_chave(_cliente_locks, str((item.get("data") or {}).get("id")))
 
 # ============================================================
 # DB – clientes_excluidos (SQLite simples)
 # ============================================================
 DB_PATH = os.getenv("DELETED_DB_PATH", "clientes_excluidos.db")
 
+# Uma conexão para o processo todo (WAL), usada via asyncio.to_thread a partir
+# dos handlers; o lock serializa o acesso entre as threads do executor
+_db = {"conn": None}
+_db_lock = threading.Lock()
+
 @contextmanager
 def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
+    with _db_lock:
+        if _db["conn"] is None:
+            conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            _db["conn"] = conn
+        yield _db["conn"]
+
+def close_db():
+    with _db_lock:
+        if _db["conn"] is not None:
+            _db["conn"].close()
+            _db["conn"] = None
 
 def init_db():
     with get_conn() as conn:
@@ -90,6 +304,20 @@ def init_db():
                 data_exclusao TEXT NOT NULL
             )
         """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS webhook_jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                criado_em TEXT NOT NULL,
+                atualizado_em TEXT NOT NULL,
+                resultados TEXT NOT NULL,
+                pendentes TEXT NOT NULL DEFAULT '[]'
+            )
+        """)
+        # bancos criados antes da coluna `pendentes`
+        colunas = {row["name"] for row in conn.execute("PRAGMA table_info(webhook_jobs)")}
+        if "pendentes" not in colunas:
+            conn.execute("ALTER TABLE webhook_jobs ADD COLUMN pendentes TEXT NOT NULL DEFAULT '[]'")
         conn.commit()
 
 def db_salvar_excluido(id_cliente: int, cpf: str):
@@ -119,95 +347,561 @@ def db_remover_excluido(id_cliente: int):
         conn.execute("DELETE FROM clientes_excluidos WHERE id_cliente = ?", (id_cliente,))
         conn.commit()
 
-# inicializa a tabela na importação
-init_db()
+def db_salvar_job(job: dict, pendentes: dict | None = None):
+    """
+    Grava o job com os itens ainda não concluídos ({índice: (tipo, item)}),
+    para que um restart consiga retomá-los.
+    """
+    pendentes_json = [[idx, tipo, item] for idx, (tipo, item) in (pendentes or {}).items()]
+    with get_conn() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO webhook_jobs (job_id, status, criado_em, atualizado_em, resultados, pendentes)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (job["job_id"], job["status"], job["criado_em"], datetime.utcnow().isoformat(),
+             orjson.dumps(job["resultados"]).decode(), orjson.dumps(pendentes_json).decode())
+        )
+        conn.commit()
+
+def db_buscar_job(job_id: str):
+    with get_conn() as conn:
+        cur = conn.execute(
+            "SELECT job_id, status, criado_em, atualizado_em, resultados FROM webhook_jobs WHERE job_id = ?",
+            (job_id,)
+        )
+        row = cur.fetchone()
+        if row:
+            job = dict(row)
+            job["resultados"] = orjson.loads(job["resultados"])
+            return job
+        return None
+
+def db_jobs_em_andamento() -> list[tuple[dict, dict]]:
+    """Jobs ainda "processando" (ex.: interrompidos por um restart), com seus pendentes."""
+    with get_conn() as conn:
+        cur = conn.execute(
+            "SELECT job_id, status, criado_em, atualizado_em, resultados, pendentes "
+            "FROM webhook_jobs WHERE status = 'processando'"
+        )
+        jobs = []
+        for row in cur.fetchall():
+            job = dict(row)
+            job["resultados"] = orjson.loads(job["resultados"])
+            pendentes = {idx: (tipo, item) for idx, tipo, item in orjson.loads(job.pop("pendentes"))}
+            jobs.append((job, pendentes))
+        return jobs
 
 # ============================================================
-# HTTP RETRY
+# HTTP CLIENT (compartilhado) / RETRY
 # ============================================================
-async def httpx_retry(method: str, url: str, **kwargs) -> httpx.Response:
-    tries, delay = 3, 1.0
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-        for i in range(tries):
-            try:
+# Um único AsyncClient para TENEX e MEDICAR: mantém as conexões keep-alive
+# no pool (por host) e evita um handshake TCP+TLS a cada chamada. Com HTTP/2
+# as requisições simultâneas ao mesmo host compartilham uma só conexão.
+_http = {"client": None, "aquecer": None}
+
+def get_http_client() -> httpx.AsyncClient:
+    if _http["client"] is None or _http["client"].is_closed:
+        _http["client"] = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=40, keepalive_expiry=30),
+        )
+    return _http["client"]
+
+async def http_aquecer():
+    """HEAD nas bases MEDICAR/TENEX a cada HTTP_AQUECER_INTERVALO s (DNS/TLS já prontos)."""
+    while True:
+        client = get_http_client()
+        for base in (MEDICAR_BASE_URL, TENEX_BASE_URL):
+            if base:
+                try:
+                    await client.head(base)
+                except httpx.HTTPError as e:
+                    log.debug(f"[HTTP] Aquecimento de {base} falhou: {e}")
+        await asyncio.sleep(HTTP_AQUECER_INTERVALO)
+
+async def app_iniciar():
+    """Tabelas do SQLite, cliente HTTP, fila e retomada dos jobs interrompidos."""
+    await asyncio.to_thread(init_db)
+    get_http_client()
+    fila_iniciar()
+    await job_retomar_interrompidos()
+    if HTTP_AQUECER_INTERVALO > 0:
+        _http["aquecer"] = asyncio.create_task(http_aquecer())
+
+async def app_encerrar():
+    """Drena a fila e fecha o aquecimento, o cliente HTTP e o SQLite."""
+    await fila_parar()
+    if _http["aquecer"] is not None:
+        _http["aquecer"].cancel()
+        _http["aquecer"] = None
+    client = _http["client"]
+    _http["client"] = None
+    if client is not None:
+        await client.aclose()
+    close_db()
+
+_upstream_sem = {
+    "medicar": asyncio.Semaphore(max(1, MEDICAR_CONCURRENCY)),
+    "tenex": asyncio.Semaphore(max(1, TENEX_CONCURRENCY)),
+}
+
+def upstream_sem(url: str) -> asyncio.Semaphore:
+    if MEDICAR_BASE_URL and url.startswith(MEDICAR_BASE_URL):
+        return _upstream_sem["medicar"]
+    return _upstream_sem["tenex"]
+
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+def erro_transitorio(e: Exception) -> bool:
+    """Falha de rede/timeout ou 429/5xx — vale tentar de novo; 4xx não."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRY_STATUS
+    return isinstance(e, httpx.TransportError)
+
+METODOS_IDEMPOTENTES = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+RETRY_AFTER_MAX = 30.0  # não espera mais que isso mesmo se o servidor pedir
+
+def retry_after(e: Exception) -> float | None:
+    """Segundos pedidos no header Retry-After de um 429/503 (número ou data HTTP)."""
+    if not isinstance(e, httpx.HTTPStatusError):
+        return None
+    valor = e.response.headers.get("retry-after")
+    if not valor:
+        return None
+    try:
+        segundos = float(valor)
+    except ValueError:
+        try:
+            segundos = (parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(segundos, 0.0), RETRY_AFTER_MAX)
+
+async def httpx_retry(method: str, url: str, idempotent: bool | None = None, **kwargs) -> httpx.Response:
+    """
+    Requisição com retry em falhas transitórias. Só repete métodos idempotentes;
+    um POST só é repetido se marcado com idempotent=True (ex.: com Idempotency-Key).
+    """
+    if idempotent is None:
+        idempotent = method.upper() in METODOS_IDEMPOTENTES
+    tries, delay = (3 if idempotent else 1), 1.0
+    client = get_http_client()
+    sem = upstream_sem(url)
+    for i in range(tries):
+        try:
+            async with sem:  # liberado durante o backoff
                 resp = await client.request(method, url, **kwargs)
-                resp.raise_for_status()
-                return resp
-            except httpx.HTTPError as e:
-                if i == tries - 1:
-                    raise
-                log.warning(f"Tentativa {i+1}/{tries} falhou para {url}: {e}")
-                await asyncio.sleep(delay)
-                delay = min(delay * 2, 6)
+            resp.raise_for_status()
+            return resp
+        except httpx.HTTPError as e:
+            if i == tries - 1 or not erro_transitorio(e):
+                raise
+            log.warning(f"Tentativa {i+1}/{tries} falhou para {url}: {e}")
+            espera = retry_after(e)
+            await asyncio.sleep(espera if espera is not None else delay + random.uniform(0, delay * 0.25))
+            delay = min(delay * 2, 6)
+
+async def medicar_post(
+    url: str,
+    payload: dict,
+    headers: dict,
+    params: dict | None = None,
+    erro_tag: str = "ERRO MEDICAR",
+    log_payload: bool = False
+):
+    """
+    POST JSON na Medicar: serializa uma vez, loga o corpo do erro e retorna o JSON da resposta.
+    Respostas de sucesso maiores que MEDICAR_RESPOSTA_MAX não são lidas/parseadas:
+    o webhook só ecoa o resultado, então basta o status.
+    """
+    body = orjson.dumps(payload)
+    # uma chave por chamada, repetida só nas tentativas abaixo: uma nova
+    # inclusão com o mesmo corpo (ex.: reentrada) não pode ser tomada por retry
+    headers = {**headers, "Idempotency-Key": uuid.uuid4().hex}
+    enviar = body
+    if MEDICAR_GZIP_REQUEST and len(body) > MEDICAR_GZIP_MIN:
+        enviar = gzip.compress(body, compresslevel=1)
+        headers["Content-Encoding"] = "gzip"
+
+    tries, delay = 3, 1.0
+    for i in range(tries):
+        try:
+            async with upstream_sem(url), get_http_client().stream(
+                "POST", url, params=params, headers=headers, content=enviar
+            ) as resp:
+                if resp.is_error:
+                    await resp.aread()
+                    enviado = f" | Payload enviado: {body.decode()}" if log_payload else ""
+                    log.error("[%s] Status: %s%s | Resposta: %s", erro_tag, resp.status_code, enviado, resp.text)
+                    resp.raise_for_status()
+
+                tamanho = int(resp.headers.get("content-length") or 0)
+                if tamanho > MEDICAR_RESPOSTA_MAX:
+                    return {"status_code": resp.status_code, "bytes": tamanho}
+                content = await resp.aread()
+            break
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            # o POST não chegou a sair → repetir não duplica a inclusão/bloqueio
+            if i == tries - 1:
+                raise
+            log.warning(f"[{erro_tag}] Tentativa {i+1}/{tries} sem conexão com {url}: {e}")
+            await asyncio.sleep(delay + random.uniform(0, delay * 0.25))
+            delay = min(delay * 2, 6)
+
+    if len(content) > MEDICAR_RESPOSTA_MAX:
+        return {"status_code": resp.status_code, "bytes": len(content)}
+    return orjson.loads(content)
 
 # ============================================================
 # TENEX
 # ============================================================
+async def _tenex_fetch_carteira(cpf_digits: str):
+    """
+    GET da carteira. Enquanto o CPF ainda não tem plano, repete a consulta com
+    If-None-Match/If-Modified-Since: se o TENEX responder 304, reaproveita o
+    corpo anterior sem retransferir/parsear. Sem ETag/Last-Modified → GET normal.
+    """
+    url = f"{TENEX_BASE_URL}/api/v2/carteira-virtual/{cpf_digits}"
+    anterior = _carteira_validadores.get(cpf_digits)
+    headers = TENEX_HEADERS
+    if anterior:
+        headers = {**TENEX_HEADERS, **anterior["condicionais"]}
+
+    try:
+        resp = await httpx_retry("GET", url, headers=headers)
+    except httpx.HTTPStatusError as e:
+        if anterior and e.response.status_code == 304:
+            return anterior["carteira"]
+        raise
+
+    carteira = orjson.loads(resp.content)
+    condicionais = {}
+    if resp.headers.get("ETag"):
+        condicionais["If-None-Match"] = resp.headers["ETag"]
+    if resp.headers.get("Last-Modified"):
+        condicionais["If-Modified-Since"] = resp.headers["Last-Modified"]
+
+    _carteira_validadores.pop(cpf_digits, None)
+    if condicionais and not _carteira_tem_plano(carteira):
+        _carteira_validadores[cpf_digits] = {"condicionais": condicionais, "carteira": carteira}
+        while len(_carteira_validadores) > CARTEIRA_CACHE_MAX:
+            _carteira_validadores.pop(next(iter(_carteira_validadores)))
+    return carteira
+
+def _carteira_tem_plano(carteira) -> bool:
+    return isinstance(carteira, list) and bool(carteira) and bool(carteira[0].get("planos_contratados"))
+
 async def tenex_get_carteira(cpf: str):
-    url = f"{TENEX_BASE_URL}/api/v2/carteira-virtual/{only_digits(cpf)}"
-    headers = {"Authorization": f"Basic {TENEX_BASIC_AUTH}"}
-    resp = await httpx_retry("GET", url, headers=headers)
-    return resp.json()
+    """
+    Carteira virtual do CPF, com cache de CARTEIRA_CACHE_TTL segundos.
+    Consultas simultâneas do mesmo CPF compartilham uma única chamada.
+    Carteiras sem plano não entram no cache (o plano pode estar a caminho).
+    """
+    cpf_digits = only_digits(cpf)
+
+    cached = _carteira_cache.get(cpf_digits)
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
+
+    async with lock_por_chave(_carteira_locks, cpf_digits):
+        cached = _carteira_cache.get(cpf_digits)
+        if cached and time.monotonic() < cached[0]:
+            return cached[1]
+
+        carteira = await _tenex_fetch_carteira(cpf_digits)
+        if _carteira_tem_plano(carteira):
+            _carteira_cache.pop(cpf_digits, None)
+            _carteira_cache[cpf_digits] = (time.monotonic() + CARTEIRA_CACHE_TTL, carteira)
+            while len(_carteira_cache) > CARTEIRA_CACHE_MAX:
+                _carteira_cache.pop(next(iter(_carteira_cache)))
+        return carteira
+
+CONTATO_CAMPOS = ("principal", "nome", "cpf", "data_nascimento", "genero")
 
 async def tenex_get_cliente_com_contatos(cliente_id: int):
     url = f"{TENEX_BASE_URL}/api/v2/clientes/?id={cliente_id}&_expand=contatos"
-    headers = {"Authorization": f"Basic {TENEX_BASIC_AUTH}"}
-    resp = await httpx_retry("GET", url, headers=headers)
-    data = resp.json()
+    resp = await httpx_retry("GET", url, headers=TENEX_HEADERS)
+    data = orjson.loads(resp.content)
     if isinstance(data, dict) and "data" in data:
         items = data["data"]
     else:
         items = data
-    return items[0] if items else None
+    if not items:
+        return None
+    # projeta só o que os fluxos usam (o cadastro completo do cliente é grande)
+    cliente = items[0]
+    return {
+        "id": cliente.get("id"),
+        "status": cliente.get("status"),
+        "contatos": [
+            {k: c.get(k) for k in CONTATO_CAMPOS}
+            for c in cliente.get("contatos") or []
+        ],
+    }
+
+def separar_contatos(contatos: list) -> tuple[dict | None, list[dict]]:
+    """Uma passada: (contato titular, contatos dependentes com CPF)."""
+    tit, deps = None, []
+    for c in contatos:
+        principal = str(c.get("principal"))
+        if principal == "1":
+            if tit is None:
+                tit = c
+        elif principal == "0" and c.get("cpf"):
+            deps.append(c)
+    return tit, deps
+
+def carteira_id_plano(carteira, cpf_digits: str):
+    """
+    Projeta da carteira TENEX só o campo usado: o id_plano do primeiro plano
+    da pessoa com esse CPF (ou da primeira pessoa). None se não houver plano.
+    """
+    if not isinstance(carteira, list) or not carteira or not carteira[0].get("planos_contratados"):
+        return None
+    pessoa = next((p for p in carteira if only_digits(p.get("cpf", "")) == cpf_digits), carteira[0])
+    return _plan_key(pessoa["planos_contratados"][0]["id_plano"])
+
+async def tenex_aguardar_plano(cpf: str, primeira: int = 0, tentativas: int = TENEX_PLANO_TENTATIVAS):
+    """
+    Consulta a carteira até o plano aparecer (o TENEX pode demorar a
+    disponibilizá-lo após o cadastro). Espera 5, 10, 20, 40, 60... s (+ até 25%
+    de jitter) entre as tentativas até completar TENEX_PLANO_ESPERA_MAX: a
+    última espera é encurtada para a consulta final cair no fim da janela.
+    `tentativas` > 0 limita o nº de consultas (1 = consulta única).
+    `primeira` > 0 retoma uma espera já iniciada (começa aguardando).
+    Com TENEX_CARTEIRA_VAZIA_MAX > 0, para antes se a carteira vier vazia
+    essa quantidade de vezes seguidas.
+    Um 404/4xx do TENEX não é repetido (httpx_retry) e sobe como erro.
+    Retorna a última carteira obtida.
+    """
+    carteira = None
+    esperado = 0.0
+    vazias = 0
+    tentativa = primeira
+    while not tentativas or tentativa < tentativas:
+        if tentativa > 0:
+            restante = TENEX_PLANO_ESPERA_MAX - esperado
+            if restante <= 0:
+                break
+            delay = min(TENEX_PLANO_DELAY_MAX, TENEX_PLANO_DELAY_BASE * 2 ** min(tentativa - 1, 16))
+            delay = delay + random.uniform(0, delay * 0.25)
+            if delay >= restante:
+                delay, esperado = restante, TENEX_PLANO_ESPERA_MAX
+            else:
+                esperado += delay
+            log.warning(f"[NOVO CLIENTE] Tentativa {tentativa}: plano não disponível para CPF {cpf}. Aguardando {delay:.1f} s ({esperado:.0f}/{TENEX_PLANO_ESPERA_MAX:.0f} s)...")
+            await asyncio.sleep(delay)
+
+        carteira = await tenex_get_carteira(cpf)
+        if _carteira_tem_plano(carteira):
+            log.info(f"[NOVO CLIENTE] Plano encontrado na tentativa {tentativa+1} para CPF {cpf}")
+            break
+        vazias = vazias + 1 if carteira == [] else 0
+        if TENEX_CARTEIRA_VAZIA_MAX and vazias >= TENEX_CARTEIRA_VAZIA_MAX:
+            log.warning(f"[NOVO CLIENTE] Carteira vazia {vazias}x seguidas para CPF {cpf} — desistindo")
+            break
+        tentativa += 1
+    return carteira
 
 # ============================================================
 # MEDICAR – TOKEN / CONTRATO
 # ============================================================
+async def _medicar_renovar_token() -> str:
+    async with _token_lock:
+        # outro coroutine pode ter renovado enquanto aguardávamos o lock
+        if _token_cache["token"] and time.monotonic() < _token_cache["refresh_at"]:
+            return _token_cache["token"]
+
+        url = f"{MEDICAR_BASE_URL}/api/oauth2/v1/token"
+        params = {"grant_type": "password", "username": MEDICAR_USERNAME, "password": MEDICAR_PASSWORD}
+
+        # emitir token é seguro de repetir → retry em falha transitória
+        resp = await httpx_retry("POST", url, idempotent=True, params=params)
+
+        data = orjson.loads(resp.content)
+        token = data.get("access_token")
+        if not token:
+            raise RuntimeError(f"Token inválido: {data}")
+
+        ttl = int(data.get("expires_in", 3600))
+        agora = time.monotonic()
+        _token_cache["token"] = token
+        _token_cache["expiry"] = agora + max(ttl - 60, 60)
+        _token_cache["refresh_at"] = agora + max(ttl - TOKEN_REFRESH_MARGIN, 30)
+
+    log.info(f"✅ Token Medicar obtido com sucesso ({resp.http_version}).")
+    return token
+
+async def _medicar_renovar_token_bg():
+    try:
+        await _medicar_renovar_token()
+    except Exception as e:
+        log.warning(f"⚠️ Renovação antecipada do token Medicar falhou: {e}")
+
 async def medicar_get_token():
-    if _token_cache["token"] and datetime.now() < _token_cache["expiry"]:
+    agora = time.monotonic()
+    if _token_cache["token"] and agora < _token_cache["expiry"]:
+        # perto de expirar: devolve o atual e renova em background (sem bloquear)
+        if agora >= _token_cache["refresh_at"] and not _token_lock.locked():
+            job_agendar(_medicar_renovar_token_bg())
         return _token_cache["token"]
 
-    url = f"{MEDICAR_BASE_URL}/api/oauth2/v1/token"
-    params = {"grant_type": "password", "username": MEDICAR_USERNAME, "password": MEDICAR_PASSWORD}
+    return await _medicar_renovar_token()
 
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-        resp = await client.post(url, params=params)
-        resp.raise_for_status()
+async def medicar_get_contract(token: str):
+    """
+    Busca contrato padrão da Medicar para obter tenantid, etc.
+    Usado como fallback quando TENANT_ID não vem por env.
+    O resultado fica em cache por CONTRACT_CACHE_TTL segundos.
+    """
+    if _contract_cache["data"] is not None and time.monotonic() < _contract_cache["expiry"]:
+        return _contract_cache["data"]
 
-    data = resp.json()
-    token = data.get("access_token")
-    if not token:
-        raise RuntimeError(f"Token inválido: {data}")
+    async with _contract_lock:
+        if _contract_cache["data"] is not None and time.monotonic() < _contract_cache["expiry"]:
+            return _contract_cache["data"]
 
-    ttl = int(data.get("expires_in", 3600)) - 60
-    _token_cache["token"] = token
-    _token_cache["expiry"] = datetime.now() + timedelta(seconds=max(ttl, 60))
+        url = f"{MEDICAR_BASE_URL}/client/v1/contract"
+        headers = {"Authorization": f"Bearer {token}"}
+        params = {
+            "cnpjmedicar": MEDICAR_CNPJMEDICAR,
+            "grupoempresa": MEDICAR_GRUPOEMPRESA,
+            "contrato": MEDICAR_CONTRATO,
+        }
+        try:
+            resp = await httpx_retry("GET", url, headers=headers, params=params)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code in (401, 403):
+                # token recusado → força nova autenticação na próxima chamada
+                _token_cache["token"] = None
+                _contract_cache["data"] = None
+            raise
+
+        data = orjson.loads(resp.content)
+        _contract_cache["data"] = data
+        _contract_cache["expiry"] = time.monotonic() + CONTRACT_CACHE_TTL
+        return data
+
+async def medicar_resolve_tenantid(token: str) -> str | None:
+    """
+    TENANT_ID do env ou, na falta dele, o tenantid do contrato padrão.
+    Depois de descoberto fica fixo para o processo (não muda por contrato).
+    """
+    if _tenant_cache["tenantid"]:
+        return _tenant_cache["tenantid"]
 
-    log.info("✅ Token Medicar obtido com sucesso.")
-    return token
+    log.info("ℹ️ TENANT_ID não definido → buscando tenant padrão...")
+    try:
+        contr = await medicar_get_contract(token)
+    except Exception as e:
+        log.warning(f"⚠️ Não foi possível obter tenant padrão: {e}")
+        return None
 
-async def medicar_get_contract(token: str):
+    tenantid = contr.get("tenantid")
+    if tenantid:
+        _tenant_cache["tenantid"] = tenantid
+        log.info(f"Tenant padrão obtido: {tenantid}")
+    return tenantid
+
+async def medicar_get_contract_by_cpf(token: str, cpf_digits: str) -> dict:
     """
-    Busca contrato padrão da Medicar para obter tenantid, etc.
-    Usado como fallback quando TENANT_ID não vem por env.
+    Contrato do beneficiário (BBA_MATRIC, tenantid...) pelo CPF, com cache de
+    MATRICULA_CACHE_TTL segundos. Sem matrícula o resultado não é guardado
+    (ela pode aparecer logo depois da inclusão do titular).
     """
+    cached = _matricula_cache.get(cpf_digits)
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
+
     url = f"{MEDICAR_BASE_URL}/client/v1/contract"
     headers = {"Authorization": f"Bearer {token}"}
     params = {
         "cnpjmedicar": MEDICAR_CNPJMEDICAR,
         "grupoempresa": MEDICAR_GRUPOEMPRESA,
         "contrato": MEDICAR_CONTRATO,
+        "cgcbeneficiario": cpf_digits,
     }
     resp = await httpx_retry("GET", url, headers=headers, params=params)
-    return resp.json()
+    contract = orjson.loads(resp.content)
+
+    if contract.get("BBA_MATRIC"):
+        _matricula_cache.pop(cpf_digits, None)
+        _matricula_cache[cpf_digits] = (time.monotonic() + MATRICULA_CACHE_TTL, contract)
+        while len(_matricula_cache) > MATRICULA_CACHE_MAX:
+            _matricula_cache.pop(next(iter(_matricula_cache)))
+    return contract
+
+def medicar_esquecer_contrato(cpf_digits: str):
+    """Descarta o contrato em cache do CPF (após cancelar a matrícula)."""
+    _matricula_cache.pop(cpf_digits, None)
 
 # ============================================================
 # MEDICAR – INCLUIR TITULAR (fluxo TOTVS)
 # ============================================================
+# Campos default da Medicar (MASTERBBA, order 1..6)
+MASTER_DEFAULTS = MappingProxyType({
+    "BBA_CODINT": "1001",
+    "BBA_CODEMP": "0004",
+    "BBA_CONEMP": "000000000002",
+    "BBA_VERCON": "001",
+    "BBA_SUBCON": "002326875",
+    "BBA_VERSUB": "001",
+})
+
+# Sub-modelo de anexos: sempre vazio, igual em toda inclusão
+DETAIL_ANEXO = {"id": "DETAILANEXO", "modeltype": "GRID", "items": [{"id": 1, "deleted": 0, "fields": []}]}
+
+def plincben_payload(master_fields: list, items: list) -> dict:
+    """Envelope PLIncBenModel (operation 3) comum a titular e dependentes."""
+    return {
+        "id": "PLIncBenModel",
+        "operation": 3,
+        "models": [{
+            "id": "MASTERBBA",
+            "modeltype": "FIELDS",
+            "fields": master_fields,
+            "models": [
+                {"id": "DETAILB2N", "modeltype": "GRID", "items": items},
+                DETAIL_ANEXO,
+            ],
+        }],
+    }
+
+def plincben_matricula(resp) -> str | None:
+    """
+    BBA_MATRIC devolvido pela inclusão, se a Medicar ecoar o modelo gravado
+    (campo no topo ou em MASTERBBA.fields). None se não vier.
+    """
+    if not isinstance(resp, dict):
+        return None
+    if resp.get("BBA_MATRIC"):
+        return resp["BBA_MATRIC"]
+    for model in resp.get("models") or ():
+        if isinstance(model, dict) and model.get("id") == "MASTERBBA":
+            for f in model.get("fields") or ():
+                if isinstance(f, dict) and f.get("id") == "BBA_MATRIC" and f.get("value"):
+                    return f["value"]
+    return None
+
+# Campos B2N do titular, na ordem enviada à Medicar
+TIT_FIELD_IDS = ("B2N_NOMUSR", "B2N_DATNAS", "B2N_GRAUPA", "B2N_ESTCIV", "B2N_SEXO", "B2N_CPFUSR", "B2N_MAE", "B2N_CODPRO")
+
+@lru_cache(maxsize=8)
+def _master_bba_contract_fields(env_values: tuple) -> tuple:
+    """Monta (uma vez por configuração) os 6 campos fixos de contrato do MASTERBBA."""
+    env_contract = {k: v for k, v in env_values if v}
+    base_contract = env_contract if env_contract else MASTER_DEFAULTS
+    return tuple(
+        {"id": k, "order": order, "value": base_contract[k]}
+        for order, k in enumerate(MASTER_DEFAULTS, start=1)
+    )
+
 async def medicar_incluir_titular(
     token: str,
     tenantid: str,
-    titular: dict,
+    titular: Pessoa,
     plano: dict,
     contract_fields: dict | None = None
 ):
@@ -225,93 +919,50 @@ async def medicar_incluir_titular(
         "tenantid": tenantid
     }
 
-    # Formatação
-    def fmt_dn(v): return v.replace("-", "") if v else ""
-    def sexo_valor(v): return "1" if str(v) == "1" else "2"
-    def mae_ok(v): return only_ascii_upper(v or "NOME MAE NAO INFORMADO")
-
-    # Campos default da Medicar
-    master_defaults = {
-        "BBA_CODINT": "1001",
-        "BBA_CODEMP": "0004",
-        "BBA_CONEMP": "000000000002",
-        "BBA_VERCON": "001",
-        "BBA_SUBCON": "002326875",
-        "BBA_VERSUB": "001",
-    }
-
-    env_contract = {k: contract_fields.get(k) for k in master_defaults if contract_fields and contract_fields.get(k)}
-    base_contract = env_contract if env_contract else master_defaults
+    # Campos de contrato: env (MEDICAR_CONTRACT_FIELDS_JSON) ou defaults
+    contract_bba_fields = _master_bba_contract_fields(
+        tuple((k, contract_fields.get(k)) for k in MASTER_DEFAULTS) if contract_fields else ()
+    )
 
-    nome = only_ascii_upper(titular["nome"])
-    cpf = only_digits(titular["cpf"])
-    dn = fmt_dn(titular["data_nascimento"])
-    sexo = sexo_valor(titular["sexo"])
-    mae = mae_ok(titular["nome_mae"])
+    # Pessoa já vem normalizada (nome ASCII maiúsculo, CPF só dígitos)
+    nome = titular.nome
+    cpf = titular.cpf
+    dn = (titular.data_nascimento or "").replace("-", "")
+    sexo = "1" if str(titular.sexo) == "1" else "2"
+    mae = titular.nome_mae or "NOME MAE NAO INFORMADO"
 
     # Campos MASTERBBA
     master_bba_fields = [
-        {"id": "BBA_CODINT", "order": 1, "value": base_contract["BBA_CODINT"]},
-        {"id": "BBA_CODEMP", "order": 2, "value": base_contract["BBA_CODEMP"]},
-        {"id": "BBA_CONEMP", "order": 3, "value": base_contract["BBA_CONEMP"]},
-        {"id": "BBA_VERCON", "order": 4, "value": base_contract["BBA_VERCON"]},
-        {"id": "BBA_SUBCON", "order": 5, "value": base_contract["BBA_SUBCON"]},
-        {"id": "BBA_VERSUB", "order": 6, "value": base_contract["BBA_VERSUB"]},
+        *contract_bba_fields,
         {"id": "BBA_EMPBEN", "order": 7, "value": nome},
         {"id": "BBA_CODPRO", "order": 8, "value": plano["codpro"]},
         {"id": "BBA_VERSAO", "order": 9, "value": plano["versao"]},
         {"id": "BBA_CPFTIT", "order": 10, "value": cpf},
     ]
 
-    # DETAIL – titular
-    items = [{
-        "id": 1,
-        "deleted": 0,
-        "fields": [
-            {"id": "B2N_NOMUSR", "value": nome},
-            {"id": "B2N_DATNAS", "value": dn},
-            {"id": "B2N_GRAUPA", "value": "00"},
-            {"id": "B2N_ESTCIV", "value": "S"},
-            {"id": "B2N_SEXO", "value": sexo},
-            {"id": "B2N_CPFUSR", "value": cpf},
-            {"id": "B2N_MAE", "value": mae},
-            {"id": "B2N_CODPRO", "value": plano["codpro"]},
-        ]
-    }]
+    # DETAIL – titular (GRAUPA 00 / ESTCIV S fixos)
+    values = (nome, dn, "00", "S", sexo, cpf, mae, plano["codpro"])
+    items = [{"id": 1, "deleted": 0, "fields": [{"id": k, "value": v} for k, v in zip(TIT_FIELD_IDS, values)]}]
 
-    payload = {
-        "id": "PLIncBenModel",
-        "operation": 3,
-        "models": [{
-            "id": "MASTERBBA",
-            "modeltype": "FIELDS",
-            "fields": master_bba_fields,
-            "models": [
-                {"id": "DETAILB2N", "modeltype": "GRID", "items": items},
-                {"id": "DETAILANEXO", "modeltype": "GRID", "items": [{"id": 1, "deleted": 0, "fields": []}]},
-            ],
-        }],
-    }
-
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-        resp = await client.post(url, params=params, headers=headers, json=payload)
+    payload = plincben_payload(master_bba_fields, items)
 
-    try:
-        resp.raise_for_status()
-    except Exception:
-        log.error(f"[ERRO TITULAR] {resp.status_code} → {resp.text}")
-        raise
-
-    return resp.json()
+    return await medicar_post(url, payload, headers=headers, params=params, erro_tag="ERRO TITULAR")
 
 # ============================================================
 # MEDICAR – INCLUIR DEPENDENTES
 # ============================================================
+# Campos B2N de um dependente, na ordem enviada à Medicar
+DEP_FIELD_IDS = ("B2N_NOMUSR", "B2N_DATNAS", "B2N_GRAUPA", "B2N_ESTCIV", "B2N_SEXO", "B2N_CPFUSR", "B2N_MAE")
+
+def dep_grid_item(i: int, nome: str, data_nas: str, sexo: str, cpf: str, mae: str) -> dict:
+    values = (nome, data_nas, "11", "S", sexo, cpf, mae)  # GRAUPA 11 / ESTCIV S fixos
+    return {"id": i, "deleted": 0, "fields": [{"id": k, "value": v} for k, v in zip(DEP_FIELD_IDS, values)]}
+
 async def medicar_incluir_dependentes(
     token: str,
     tenantid: str,
     matricula: str,
-    dependentes: list
+    dependentes: list[Pessoa]
 ):
     """
     Inclui dependentes em um titular já existente na Medicar.
@@ -325,62 +976,20 @@ async def medicar_incluir_dependentes(
         "tenantid": tenantid
     }
 
-    items = []
-
-    for i, dep in enumerate(dependentes, start=1):
-
-        nome = only_ascii_upper(dep.get("nome") or "")
-        data_nas = dep.get("data_nascimento") or ""
-        sexo = str(dep.get("sexo") or "2")
-        cpf = only_digits(dep.get("cpf") or "")
-        mae = only_ascii_upper(dep.get("nome_mae") or "NOME MAE NAO INFORMADO")
-
-        if not nome or not cpf or not data_nas:
-            log.warning(f"[DEPENDENTE IGNORADO] Falta nome/cpf/data")
-            continue
-
-        items.append({
-            "id": i,
-            "deleted": 0,
-            "fields": [
-                {"id": "B2N_NOMUSR", "value": nome},
-                {"id": "B2N_DATNAS", "value": data_nas},
-                {"id": "B2N_GRAUPA", "value": "11"},
-                {"id": "B2N_ESTCIV", "value": "S"},
-                {"id": "B2N_SEXO", "value": sexo},
-                {"id": "B2N_CPFUSR", "value": cpf},
-                {"id": "B2N_MAE", "value": mae}
-            ]
-        })
+    # Pessoa já vem normalizada; só descarta quem não tem nome/cpf/data
+    items = [
+        dep_grid_item(i, dep.nome, dep.data_nascimento, dep.sexo, dep.cpf, dep.nome_mae)
+        for i, dep in enumerate(dependentes, start=1)
+        if dep.nome and dep.cpf and dep.data_nascimento
+    ]
+    if len(items) < len(dependentes):
+        log.warning(f"[DEPENDENTE IGNORADO] {len(dependentes) - len(items)} sem nome/cpf/data")
 
-    payload = {
-        "id": "PLIncBenModel",
-        "operation": 3,
-        "models": [{
-            "id": "MASTERBBA",
-            "modeltype": "FIELDS",
-            "fields": [
-                {"id": "BBA_MATRIC", "order": 1, "value": matricula}
-            ],
-            "models": [
-                {"id": "DETAILB2N", "modeltype": "GRID", "items": items},
-                {"id": "DETAILANEXO", "modeltype": "GRID", "items": [{"id": 1, "deleted": 0, "fields": []}]}
-            ]
-        }]
-    }
+    payload = plincben_payload([{"id": "BBA_MATRIC", "order": 1, "value": matricula}], items)
 
     log.info(f"[MEDICAR] Incluindo {len(items)} dependente(s) → matrícula {matricula}")
 
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-        resp = await client.post(url, params=params, headers=headers, json=payload)
-
-    try:
-        resp.raise_for_status()
-    except Exception:
-        log.error(f"[ERRO DEPENDENTES] {resp.status_code} → {resp.text}")
-        raise
-
-    return resp.json()
+    return await medicar_post(url, payload, headers=headers, params=params, erro_tag="ERRO DEPENDENTES")
 
 # ============================================================
 # MEDICAR – CANCELAR MATRÍCULA
@@ -413,28 +1022,28 @@ async def medicar_encerrar_matricula(
         "loginUser": login_user
     }
 
-    log.info(f"[CANCELAR] Enviando payload: {json.dumps(payload)} | tenantid: {tenantid}")
-
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-        resp = await client.post(url, headers=headers, json=payload)
-
-    try:
-        resp.raise_for_status()
-    except Exception:
-        log.error(f"[ERRO CANCELAR] Status: {resp.status_code} | Payload enviado: {json.dumps(payload)} | Resposta: {resp.text}")
-        raise
+    log.info("[CANCELAR] Enviando payload: %s | tenantid: %s", payload, tenantid)
 
-    return resp.json()
+    return await medicar_post(url, payload, headers=headers, erro_tag="ERRO CANCELAR", log_payload=True)
 
 # ============================================================
 # HELPER – PROCESSAR UM ITEM COMO "NOVO CLIENTE"
 # ============================================================
 async def process_novo_cliente_item(
     item: dict,
-    token: str,
+    token: str | None,
     tenantid: str,
-    contract_fields: dict | None
+    contract_fields: dict | None,
+    aguardar_plano: bool = True,
+    primeira_tentativa: int = 0,
+    cliente_expand: dict | None = None
 ) -> dict:
+    """
+    aguardar_plano=False → consulta a carteira uma única vez e, sem plano,
+    devolve status "pendente" (o webhook reprocessa em background).
+    token=None → o token é obtido depois da espera pelo plano.
+    cliente_expand → cliente TENEX (com contatos) já buscado pelo chamador.
+    """
     header = item.get("header") or {}
     data = item.get("data") or {}
 
@@ -448,28 +1057,35 @@ async def process_novo_cliente_item(
             "data": data
         }
 
+    # Os contatos não dependem do plano: busca em paralelo com a carteira
+    contatos_task = None
+    if cliente_expand is None:
+        contatos_task = asyncio.create_task(tenex_get_cliente_com_contatos(id_cliente))
+
     try:
-        # 1️⃣ Buscar plano na TENEX (com retry de 5 tentativas)
-        carteira = None
-        for tentativa in range(5):
-            carteira = await tenex_get_carteira(cpf)
-            if isinstance(carteira, list) and carteira and carteira[0].get("planos_contratados"):
-                log.info(f"[NOVO CLIENTE] Plano encontrado na tentativa {tentativa+1} para CPF {cpf}")
-                break
-            log.warning(f"[NOVO CLIENTE] Tentativa {tentativa+1}/5: plano não disponível para CPF {cpf}. Aguardando 60 s...")
-            await asyncio.sleep(60)
+        # 1️⃣ Buscar plano na TENEX (com retry e backoff exponencial)
+        if aguardar_plano:
+            carteira = await tenex_aguardar_plano(cpf, primeira=primeira_tentativa)
+        else:
+            carteira = await tenex_aguardar_plano(cpf, tentativas=1)
+        id_plano = carteira_id_plano(carteira, only_digits(cpf))
 
-        if not carteira or not carteira[0].get("planos_contratados"):
+        if id_plano is None and not aguardar_plano:
             return {
                 "cpf": cpf,
-                "status": "ignorado",
-                "motivo": "Nenhum plano encontrado após 5 tentativas"
+                "status": "pendente",
+                "motivo": "Plano ainda não disponível no TENEX — reprocessando em background"
             }
 
-        pessoa = next((p for p in carteira if only_digits(p.get("cpf", "")) == only_digits(cpf)), carteira[0])
-        id_plano = pessoa["planos_contratados"][0]["id_plano"]
+        if id_plano is None:
+            return {
+                "cpf": cpf,
+                "status": "ignorado",
+                "motivo": (f"Nenhum plano encontrado após {TENEX_PLANO_ESPERA_MAX:.0f} s de espera"
+                           if carteira else "CPF sem carteira no TENEX")
+            }
 
-        plano = PLAN_MAPPING_JSON.get(str(id_plano))
+        plano = PLAN_MAPPING_JSON.get(id_plano)
         if not plano:
             return {
                 "cpf": cpf,
@@ -477,62 +1093,42 @@ async def process_novo_cliente_item(
                 "motivo": f"plano {id_plano} não mapeado"
             }
 
-        # 2️⃣ Buscar titular e dependentes no TENEX
-        cliente_expand = await tenex_get_cliente_com_contatos(id_cliente)
-        contatos = (cliente_expand or {}).get("contatos", []) if cliente_expand else []
-
-        tit = next((c for c in contatos if str(c.get("principal")) == "1"), None)
-        titular_dict = {
-            "nome": only_ascii_upper((tit or data).get("nome") or ""),
-            "cpf": only_digits((tit or data).get("cpf") or ""),
-            "data_nascimento": ((tit or data).get("data_nascimento") or "").replace("-", ""),
-            "sexo": str((tit or data).get("genero") or "2"),
-            "nome_mae": "NOME MAE NAO INFORMADO",
-        }
+        if token is None:
+            token = await medicar_get_token()
 
-        dependentes_dicts = []
-        for dep in contatos:
-            if str(dep.get("principal")) != "0":
-                continue
-            if not dep.get("cpf"):
-                continue
-            dependentes_dicts.append({
-                "nome": only_ascii_upper(dep.get("nome") or ""),
-                "cpf": only_digits(dep.get("cpf") or ""),
-                "data_nascimento": (dep.get("data_nascimento") or "").replace("-", ""),
-                "sexo": str(dep.get("genero") or "2"),
-                "nome_mae": "NOME MAE NAO INFORMADO",
-            })
-
-        if not titular_dict["nome"] or not titular_dict["cpf"]:
+        # 2️⃣ Titular e dependentes no TENEX (busca iniciada acima)
+        if contatos_task is not None:
+            cliente_expand = await contatos_task
+        contatos = (cliente_expand or {}).get("contatos", [])
+
+        tit, deps = separar_contatos(contatos)
+        tit = tit or data
+        titular = Pessoa.from_contato(tit)
+        dependentes = [Pessoa.from_contato(dep) for dep in deps]
+
+        if not titular.nome or not titular.cpf:
             return {"cpf": cpf, "status": "erro", "erro": "Titular inválido (sem nome/CPF)"}
 
         # 3️⃣ Incluir TITULAR na Medicar
         resp_titular = await medicar_incluir_titular(
             token=token,
             tenantid=tenantid,
-            titular=titular_dict,
+            titular=titular,
             plano=plano,
             contract_fields=contract_fields,
         )
 
-        log.info(f"[NOVO CLIENTE] Titular incluído → CPF {titular_dict['cpf']}")
-
-        # 4️⃣ Buscar a matrícula recém-criada
-        url_mat = f"{MEDICAR_BASE_URL}/client/v1/contract"
-        headers_medicar = {"Authorization": f"Bearer {token}"}
-        params_mat = {
-            "cnpjmedicar": MEDICAR_CNPJMEDICAR,
-            "grupoempresa": MEDICAR_GRUPOEMPRESA,
-            "contrato": MEDICAR_CONTRATO,
-            "cgcbeneficiario": only_digits(titular_dict["cpf"]),
-        }
-
-        resp_mat = await httpx_retry("GET", url_mat, headers=headers_medicar, params=params_mat)
-        contr_data = resp_mat.json()
+        log.info(f"[NOVO CLIENTE] Titular incluído → CPF {titular.cpf}")
 
-        matricula = contr_data.get("BBA_MATRIC")
-        tenant_dep = contr_data.get("tenantid") or tenantid
+        # 4️⃣ Matrícula recém-criada: da resposta da inclusão, se vier; senão
+        #    busca no contrato (só existe após a inclusão do titular — não dá
+        #    para antecipar como os contatos)
+        matricula = plincben_matricula(resp_titular)
+        tenant_dep = tenantid
+        if not matricula:
+            contr_data = await medicar_get_contract_by_cpf(token, titular.cpf)
+            matricula = contr_data.get("BBA_MATRIC")
+            tenant_dep = contr_data.get("tenantid") or tenantid
 
         if not matricula:
             return {
@@ -542,18 +1138,18 @@ async def process_novo_cliente_item(
             }
 
         # 5️⃣ Incluir DEPENDENTES (se houver)
-        if dependentes_dicts:
+        if dependentes:
             resp_dep = await medicar_incluir_dependentes(
                 token=token,
                 tenantid=tenant_dep,
                 matricula=matricula,
-                dependentes=dependentes_dicts,
+                dependentes=dependentes,
             )
         else:
             resp_dep = {"mensagem": "Nenhum dependente encontrado"}
 
         return {
-            "cpf": titular_dict["cpf"],
+            "cpf": titular.cpf,
             "status": "cadastrado",
             "titular": resp_titular,
             "dependentes": resp_dep,
@@ -567,6 +1163,231 @@ async def process_novo_cliente_item(
             "erro": str(e),
         }
 
+    finally:
+        # saída antes de usar os contatos (sem plano, erro...) → descarta a busca
+        if contatos_task is not None:
+            if not contatos_task.done():
+                contatos_task.cancel()
+            elif not contatos_task.cancelled():
+                contatos_task.exception()  # marca como consumida (evita aviso do asyncio)
+
+
+
+# ============================================================
+# JOBS EM BACKGROUND – novo cliente com plano ainda pendente
+# ============================================================
+JOBS_MAX = 1000                  # registros de job mantidos em memória (todos ficam no SQLite)
+_jobs: dict[str, dict] = {}
+_jobs_pendentes: dict[str, dict[int, tuple[str, dict]]] = {}  # itens ainda não concluídos por job
+_background_tasks: set = set()   # referência forte às tasks em execução
+
+async def job_criar(resultados: list, pendentes: dict[int, tuple[str, dict]]) -> str:
+    """
+    Registra um job com `pendentes` ({índice: (tipo, item)}) a processar.
+    Os itens vão para o SQLite junto com o job (retomados após um restart).
+    """
+    job_id = uuid.uuid4().hex
+    _jobs[job_id] = {
+        "job_id": job_id,
+        "status": "processando",
+        "criado_em": datetime.utcnow().isoformat(),
+        "resultados": resultados,
+    }
+    _jobs_pendentes[job_id] = dict(pendentes)
+    await asyncio.to_thread(db_salvar_job, _jobs[job_id], _jobs_pendentes[job_id])
+    while len(_jobs) > JOBS_MAX:
+        _jobs.pop(next(iter(_jobs)))
+    return job_id
+
+async def job_item_concluido(job: dict, idx: int, result: dict):
+    """Grava o resultado do item; o job fecha ("concluido") quando não restar pendente."""
+    job_id = job["job_id"]
+    job["resultados"][idx] = result
+    pendentes = _jobs_pendentes.get(job_id, {})
+    pendentes.pop(idx, None)
+    if not pendentes:
+        _jobs_pendentes.pop(job_id, None)
+        job["status"] = "concluido"
+        log.info(f"[JOB {job_id}] Concluído")
+    await asyncio.to_thread(db_salvar_job, job, pendentes)
+
+async def job_reprocessar_pendentes(
+    job_id: str,
+    pendentes: dict[int, dict],
+    tenantid: str,
+    contract_fields: dict | None
+):
+    """Continua a espera pelo plano dos itens pendentes e grava cada resultado no job."""
+    job = _jobs[job_id]
+    sem = asyncio.Semaphore(max(1, WEBHOOK_CONCURRENCY))
+
+    async def worker(idx: int, item: dict):
+        async with cliente_lock(item), sem:
+            try:
+                result = await process_novo_cliente_item(
+                    item=item,
+                    token=None,
+                    tenantid=tenantid,
+                    contract_fields=contract_fields,
+                    primeira_tentativa=1
+                )
+            except Exception as e:
+                log.exception(f"[JOB {job_id}] Erro ao reprocessar item {idx}")
+                result = {"status": "erro", "erro": str(e)}
+        await job_item_concluido(job, idx, result)
+
+    await asyncio.gather(*(worker(idx, item) for idx, item in pendentes.items()))
+
+async def job_retomar(job: dict):
+    """Processa de novo os itens pendentes de um job interrompido por restart."""
+    job_id = job["job_id"]
+    sem = asyncio.Semaphore(max(1, WEBHOOK_CONCURRENCY))
+
+    async def worker(idx: int, tipo: str, item: dict):
+        async with cliente_lock(item), sem:
+            try:
+                result = await fila_processar_item(tipo, item)
+            except Exception as e:
+                log.exception(f"[JOB {job_id}] Erro ao retomar item {idx}")
+                result = {"status": "erro", "erro": str(e)}
+        await job_item_concluido(job, idx, result)
+
+    pendentes = list(_jobs_pendentes.get(job_id, {}).items())
+    await asyncio.gather(*(worker(idx, tipo, item) for idx, (tipo, item) in pendentes))
+
+async def job_retomar_interrompidos():
+    """
+    No startup: jobs que ficaram "processando" são retomados a partir dos
+    itens gravados; sem itens para retomar, o job é fechado como "interrompido".
+    """
+    for job, pendentes in await asyncio.to_thread(db_jobs_em_andamento):
+        job_id = job["job_id"]
+        if not pendentes:
+            job["status"] = "interrompido"
+            job["resultados"] = [
+                {"status": "erro", "erro": "interrompido"} if r.get("status") in ("pendente", "na_fila") else r
+                for r in job["resultados"]
+            ]
+            await asyncio.to_thread(db_salvar_job, job)
+            log.warning(f"[JOB {job_id}] Sem itens para retomar — marcado como interrompido")
+            continue
+        log.info(f"[JOB {job_id}] Retomando {len(pendentes)} item(ns) após restart")
+        _jobs[job_id] = job
+        _jobs_pendentes[job_id] = pendentes
+        job_agendar(job_retomar(job))
+
+def job_agendar(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+# ----------------------------
+# Fila dos webhooks (WEBHOOK_ASSINCRONO=1)
+# ----------------------------
+_webhook_fila: asyncio.Queue = asyncio.Queue(maxsize=max(1, WEBHOOK_FILA_MAX))
+_fila_workers: list[asyncio.Task] = []
+_fila_interrompidos: list[tuple[dict, int, dict | None]] = []  # (job, idx, resultado) do item em processamento no cancelamento
+
+async def fila_processar_item(tipo: str, item: dict) -> dict:
+    token = await medicar_get_token()
+    tenantid = await medicar_resolve_tenantid(token)
+    processar = process_novo_cliente_item if tipo == "novo-cliente" else process_dependentes_item
+    return await processar(item=item, token=token, tenantid=tenantid, contract_fields=CONTRACT_FIELDS)
+
+async def fila_worker():
+    """
+    Consome a fila até ser cancelado. Erros do item viram resultado "erro";
+    erros ao gravar o resultado são logados e o worker segue para o próximo.
+    """
+    while True:
+        job, idx, tipo, item = await _webhook_fila.get()
+        job_id = job["job_id"]
+        result = None
+        try:
+            try:
+                async with cliente_lock(item):
+                    result = await fila_processar_item(tipo, item)
+            except Exception as e:
+                log.exception(f"[JOB {job_id}] Erro ao processar item {idx}")
+                result = {"status": "erro", "erro": str(e)}
+            await job_item_concluido(job, idx, result)
+        except asyncio.CancelledError:
+            _fila_interrompidos.append((job, idx, result))
+            raise
+        except Exception:
+            log.exception(f"[JOB {job_id}] Erro ao gravar o resultado do item {idx}")
+        finally:
+            _webhook_fila.task_done()
+
+def fila_iniciar():
+    if WEBHOOK_ASSINCRONO and not _fila_workers:
+        _fila_workers.extend(asyncio.create_task(fila_worker()) for _ in range(max(1, WEBHOOK_CONCURRENCY)))
+
+async def fila_parar():
+    """
+    Shutdown: espera a fila esvaziar por até WEBHOOK_FILA_DRENAR_MAX s e só
+    então cancela os workers. Só os itens que estavam em processamento são
+    gravados como {"status": "erro", "erro": "interrompido"}; os que nem saíram
+    da fila continuam pendentes no SQLite e são retomados no próximo startup.
+    """
+    if not _fila_workers:
+        return
+    try:
+        await asyncio.wait_for(_webhook_fila.join(), timeout=WEBHOOK_FILA_DRENAR_MAX)
+    except asyncio.TimeoutError:
+        log.warning(f"[FILA] Shutdown com {_webhook_fila.qsize()} item(ns) ainda na fila")
+
+    for task in _fila_workers:
+        task.cancel()
+    await asyncio.gather(*_fila_workers, return_exceptions=True)
+    _fila_workers.clear()
+
+    interrompidos = list(_fila_interrompidos)
+    _fila_interrompidos.clear()
+    for job, idx, result in interrompidos:
+        # cancelado já gravando → guarda o resultado obtido
+        await job_item_concluido(job, idx, result or {"status": "erro", "erro": "interrompido"})
+    for job in {id(j): j for j, _, _ in interrompidos}.values():
+        if job["status"] == "concluido":
+            job["status"] = "interrompido"
+            await asyncio.to_thread(db_salvar_job, job)
+    if interrompidos:
+        log.warning(f"[FILA] {len(interrompidos)} item(ns) interrompido(s) no shutdown")
+
+    na_fila = 0
+    while not _webhook_fila.empty():
+        _webhook_fila.get_nowait()
+        _webhook_fila.task_done()
+        na_fila += 1
+    if na_fila:
+        log.warning(f"[FILA] {na_fila} item(ns) ainda na fila — ficam pendentes para o próximo startup")
+
+async def webhook_enfileirar(tipo: str, items: list, results: list, response: Response) -> dict:
+    """
+    Coloca os itens válidos (results[i] is None) na fila e responde 202 com
+    um job consultável em /webhook/status/{job_id}. Fila cheia → 503.
+    """
+    validos = [i for i, r in enumerate(results) if r is None]
+    if WEBHOOK_FILA_MAX - _webhook_fila.qsize() < len(validos):
+        log.warning(f"[FILA] Cheia ({_webhook_fila.qsize()} item(ns)) — webhook {tipo} recusado")
+        response.status_code = 503
+        return {"status": "erro", "mensagem": "Fila de processamento cheia, tente novamente"}
+
+    job_id = await job_criar(
+        [r or {"status": "na_fila"} for r in results],
+        {i: (tipo, items[i]) for i in validos}
+    )
+    job = _jobs[job_id]
+    for i in validos:
+        _webhook_fila.put_nowait((job, i, tipo, items[i]))
+
+    response.status_code = 202
+    return {
+        "status": "aceito",
+        "job_id": job_id,
+        "status_url": f"/webhook/status/{job_id}",
+        "resultados": job["resultados"]
+    }
 
 
 # ----------------------------
@@ -593,18 +1414,8 @@ async def cancelar_por_cpf_core(
     cpf_digits = only_digits(cpf)
 
     # 1) Buscar matrícula (BBA_MATRIC)
-    url = f"{MEDICAR_BASE_URL}/client/v1/contract"
-    headers = {"Authorization": f"Bearer {token}"}
-    params = {
-        "cnpjmedicar": MEDICAR_CNPJMEDICAR,
-        "grupoempresa": MEDICAR_GRUPOEMPRESA,
-        "contrato": MEDICAR_CONTRATO,
-        "cgcbeneficiario": cpf_digits
-    }
-
     try:
-        resp = await httpx_retry("GET", url, headers=headers, params=params)
-        contract = resp.json()
+        contract = await medicar_get_contract_by_cpf(token, cpf_digits)
     except Exception as e:
         return {
             "cpf": cpf_digits,
@@ -634,6 +1445,7 @@ async def cancelar_por_cpf_core(
             block_date=block_date,
             login_user=login_user
         )
+        medicar_esquecer_contrato(cpf_digits)
         return {
             "cpf": cpf_digits,
             "status": "cancelado",
@@ -657,383 +1469,457 @@ async def cancelar_por_cpf_core(
 # ============================================================
 # 1) WEBHOOK – NOVO CLIENTE (insert)
 # ============================================================
-@app.post("/webhook/novo-cliente")
-async def webhook_novo_cliente(request: Request):
-    body = await request.json()
-    items = body if isinstance(body, list) else [body]
+async def webhook_itens(request: Request) -> list:
+    """Corpo do webhook (objeto ou lista) parseado com orjson; JSON inválido → ValueError."""
+    body = orjson.loads(await request.body())
+    return body if isinstance(body, list) else [body]
 
-    log.info(f"[WEBHOOK NOVO CLIENTE] Recebido: {items}")
-
-    # Token Medicar
-    try:
-        token = await medicar_get_token()
-    except Exception as e:
-        return {"status": "erro", "mensagem": f"Erro obtendo token: {e}"}
+def webhook_json_invalido(e: Exception) -> OrjsonResponse:
+    log.warning(f"[WEBHOOK] Corpo não é um JSON válido: {e}")
+    return OrjsonResponse({"status": "erro", "mensagem": f"JSON inválido: {e}"}, status_code=400)
 
-    tenantid = TENANT_ID
-
-    # Caso tenant venha vazio → pega do contrato padrão
-    if not tenantid:
+async def webhook_ndjson(results: list, validos: dict, worker):
+    """
+    Corpo NDJSON de um webhook: primeiro os itens já resolvidos na
+    pré-validação, depois cada item de `validos` ({índice: item}) na ordem em
+    que terminar. As tarefas ficam em _background_tasks e seguem até o fim
+    mesmo se o cliente desconectar no meio do stream.
+    """
+    async def com_indice(i: int, item: dict) -> tuple[int, dict]:
         try:
-            contr = await medicar_get_contract(token)
-            tenantid = contr.get("tenantid")
+            return i, await worker(item)
         except Exception as e:
-            log.warning(f"Não foi possível obter tenant padrão: {e}")
-            tenantid = None
+            return i, {"status": "erro", "erro": str(e)}
 
-    contract_fields = json.loads(MEDICAR_CONTRACT_FIELDS_JSON) if MEDICAR_CONTRACT_FIELDS_JSON else None
-    results = []
+    tasks = [asyncio.create_task(com_indice(i, item)) for i, item in validos.items()]
+    for task in tasks:
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
 
-    for item in items:
-        header = item.get("header") or {}
-        op = (header.get("operation") or "").lower()
-        if op and op != "insert":
-            results.append({
-                "status": "ignorado",
-                "motivo": f"operation diferente de insert ({op})",
-                "raw_header": header
-            })
-            continue
+    for i, r in enumerate(results):
+        if r is not None:
+            yield orjson.dumps({"indice": i, **r}) + b"\n"
+    for fut in asyncio.as_completed(tasks):
+        i, r = await fut
+        yield orjson.dumps({"indice": i, **r}) + b"\n"
 
-        result_item = await process_novo_cliente_item(
-            item=item,
-            token=token,
-            tenantid=tenantid,
-            contract_fields=contract_fields
-        )
-        results.append(result_item)
+class WebhookItem(BaseModel):
+    header: Optional[dict] = None
+    data: Optional[dict] = None
 
-    return {"status": "ok", "resultados": results}
+def novo_cliente_pre_validar(item) -> dict | None:
+    """
+    Validação sem I/O de um item do webhook. Retorna o resultado final para
+    itens que não serão processados (não-insert, sem cpf/id) ou None se ok.
+    """
+    try:
+        parsed = WebhookItem.model_validate(item)
+    except ValidationError as e:
+        return {"status": "erro", "motivo": "Item do webhook inválido", "erro": str(e)}
 
-# ============================================================
-# 2) WEBHOOK – ATUALIZAÇÃO / DEPENDENTES (update + delete)
-# ============================================================
-@app.post("/webhook/dependentes")
-async def webhook_dependentes(request: Request):
-    body = await request.json()
-    items = body if isinstance(body, list) else [body]
+    header = parsed.header or {}
+    op = str(header.get("operation") or "").lower()
+    if op and op != "insert":
+        return {
+            "status": "ignorado",
+            "motivo": f"operation diferente de insert ({op})",
+            "raw_header": header
+        }
 
-    log.info("\n\n======================  📩 WEBHOOK DEPENDENTES RECEBIDO  ======================\n")
-    log.info(json.dumps(items, indent=2, ensure_ascii=False))
+    data = parsed.data or {}
+    if not data.get("cpf") or not data.get("id"):
+        return {
+            "status": "erro",
+            "motivo": "Webhook sem cpf ou id_cliente em data",
+            "data": data
+        }
+    return None
 
-    # -------------------------------------------------------------------------
-    # TOKEN MEDICAR
-    # -------------------------------------------------------------------------
+@app.post("/webhook/novo-cliente")
+async def webhook_novo_cliente(request: Request, response: Response):
+    try:
+        items = await webhook_itens(request)
+    except orjson.JSONDecodeError as e:
+        return webhook_json_invalido(e)
+
+    log.info("[WEBHOOK NOVO CLIENTE] Recebido: %d item(ns)", len(items))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("[WEBHOOK NOVO CLIENTE] Corpo: %s", items)
+
+    # Itens inválidos/ignorados são resolvidos antes de qualquer chamada externa
+    results = [novo_cliente_pre_validar(item) for item in items]
+    validos = [i for i, r in enumerate(results) if r is None]
+    if not validos:
+        return {"status": "ok", "resultados": results}
+    if WEBHOOK_ASSINCRONO:
+        return await webhook_enfileirar("novo-cliente", items, results, response)
+
+    # Token Medicar
     try:
-        log.info("🔑 Obtendo token da Medicar...")
         token = await medicar_get_token()
-        log.info("🔑 Token da Medicar obtido com sucesso.")
     except Exception as e:
-        log.error("❌ ERRO ao obter token da Medicar")
         return {"status": "erro", "mensagem": f"Erro obtendo token: {e}"}
 
-    tenantid = TENANT_ID
-    if not tenantid:
-        log.info("ℹ️ TENANT_ID não definido → buscando tenant padrão...")
-        try:
-            contr = await medicar_get_contract(token)
-            tenantid = contr.get("tenantid")
-            log.info(f"Tenant padrão obtido: {tenantid}")
-        except Exception as e:
-            log.warning(f"⚠️ Não foi possível obter tenant padrão: {e}")
-            tenantid = None
+    # TENANT_ID do env ou, se vazio, o do contrato padrão (em cache)
+    tenantid = await medicar_resolve_tenantid(token)
+
+    contract_fields = CONTRACT_FIELDS
 
-    contract_fields = json.loads(MEDICAR_CONTRACT_FIELDS_JSON) if MEDICAR_CONTRACT_FIELDS_JSON else None
-    results = []
+    # Clientes diferentes são independentes → processa em paralelo, com limite de
+    # concorrência; itens do mesmo cliente seguem em ordem (cliente_lock)
+    sem = asyncio.Semaphore(max(1, WEBHOOK_CONCURRENCY))
 
-    # =========================================================================
-    # PROCESSAR CADA ITEM DO WEBHOOK
-    # =========================================================================
-    for item in items:
+    async def worker(item: dict) -> dict:
+        async with cliente_lock(item), sem:
+            return await process_novo_cliente_item(
+                item=item,
+                token=token,
+                tenantid=tenantid,
+                contract_fields=contract_fields,
+                aguardar_plano=not WEBHOOK_PENDENTES_BACKGROUND
+            )
 
-        header = item.get("header") or {}
-        data = item.get("data") or {}
+    processados = await asyncio.gather(*(worker(items[i]) for i in validos), return_exceptions=True)
+    for i, r in zip(validos, processados):
+        results[i] = {"status": "erro", "erro": str(r)} if isinstance(r, BaseException) else r
 
-        op = (header.get("operation") or "").lower()
-        if op != "update":
-            log.info(f"⏭️ Ignorado: operation '{op}' ≠ 'update'")
-            results.append({
-                "status": "ignorado",
-                "motivo": f"operation diferente de update ({op})",
-                "raw_header": header
-            })
-            continue
+    # WEBHOOK_PENDENTES_BACKGROUND=1: itens cujo plano ainda não apareceu no
+    # TENEX seguem em background; responde 202 na hora, com um job consultável
+    # em /webhook/status/{job_id}
+    pendentes = {i: items[i] for i, r in enumerate(results) if r.get("status") == "pendente"}
+    if not pendentes:
+        return {"status": "ok", "resultados": results}
 
-        cpf = data.get("cpf")
-        id_cliente = data.get("id")
+    job_id = await job_criar(results, {i: ("novo-cliente", item) for i, item in pendentes.items()})
+    job_agendar(job_reprocessar_pendentes(job_id, pendentes, tenantid, contract_fields))
 
-        if not cpf or not id_cliente:
-            log.error("❌ Webhook sem cpf ou id_cliente no campo data")
-            results.append({
-                "status": "erro",
-                "motivo": "Webhook sem cpf ou id_cliente",
-                "data": data
-            })
-            continue
+    response.status_code = 202
+    return {
+        "status": "aceito",
+        "job_id": job_id,
+        "status_url": f"/webhook/status/{job_id}",
+        "resultados": results
+    }
 
-        cpf_digits = only_digits(cpf)
+@app.get("/webhook/status/{job_id}")
+async def webhook_status(job_id: str, response: Response):
+    # memória primeiro; jobs antigos (ou de antes de um restart) vêm do SQLite
+    job = _jobs.get(job_id) or await asyncio.to_thread(db_buscar_job, job_id)
+    if not job:
+        response.status_code = 404
+        return {"status": "erro", "mensagem": "job não encontrado"}
+    return job
 
-        log.info("\n------------------------------")
-        log.info(f"👤 PROCESSANDO CLIENTE {id_cliente} | CPF {cpf_digits}")
-        log.info("------------------------------")
+# ============================================================
+# 2) WEBHOOK – ATUALIZAÇÃO / DEPENDENTES (update + delete)
+# ============================================================
+def dependentes_pre_validar(item) -> dict | None:
+    """
+    Validação sem I/O de um item do webhook de dependentes. Retorna o
+    resultado final para itens que não serão processados ou None se ok.
+    """
+    try:
+        parsed = WebhookItem.model_validate(item)
+    except ValidationError as e:
+        return {"status": "erro", "motivo": "Item do webhook inválido", "erro": str(e)}
+
+    header = parsed.header or {}
+    op = str(header.get("operation") or "").lower()
+    if op != "update":
+        log.info(f"⏭️ Ignorado: operation '{op}' ≠ 'update'")
+        return {
+            "status": "ignorado",
+            "motivo": f"operation diferente de update ({op})",
+            "raw_header": header
+        }
 
-        try:
+    data = parsed.data or {}
+    if not data.get("cpf") or not data.get("id"):
+        log.error("❌ Webhook sem cpf ou id_cliente no campo data")
+        return {
+            "status": "erro",
+            "motivo": "Webhook sem cpf ou id_cliente",
+            "data": data
+        }
+    return None
 
-            # -----------------------------------------------------------------
-            # 1) BUSCAR CLIENTE + CONTATOS NO TENEX
-            # -----------------------------------------------------------------
-            log.info("📡 Buscando cliente no TENEX (com expand=contatos)...")
-            cliente_expand = await tenex_get_cliente_com_contatos(id_cliente)
+async def dependentes_verificar_plano(cpf_digits: str, exclusao: bool = False) -> dict | None:
+    """
+    Confere na carteira TENEX se o CPF tem plano mapeado para a Medicar.
+    Retorna None se tiver; senão, o resultado "ignorado" do item.
+    """
+    sufixo = " — exclusão ignorada." if exclusao else " — ignorado"
+    carteira = await tenex_get_carteira(cpf_digits)
+    id_plano = carteira_id_plano(carteira, cpf_digits)
 
-            if not cliente_expand:
-                log.error("❌ Cliente não encontrado no TENEX")
-                results.append({
-                    "cpf": cpf_digits,
-                    "status": "erro",
-                    "erro": "Cliente não encontrado no TENEX"
-                })
-                continue
-
-            status_tenex = cliente_expand.get("status")
-            contatos = cliente_expand.get("contatos", [])
-
-            log.info(f"📄 Status TENEX do cliente {id_cliente}: {status_tenex}")
-            log.info(f"📄 Total de contatos retornados: {len(contatos)}")
-
-
-            # =================================================================
-            # 🔴 2) STATUS = 2 → FLUXO DE EXCLUSÃO
-            # =================================================================
-            if status_tenex == 2:
-                log.info("\n🚨🚨🚨 CLIENTE INATIVO — INICIANDO FLUXO DE EXCLUSÃO 🚨🚨🚨\n")
-
-                # --------------------------
-                # Verificar plano
-                # --------------------------
-                log.info("📡 Verificando plano via carteira-virtual...")
-                carteira = await tenex_get_carteira(cpf_digits)
-                first = carteira[0] if isinstance(carteira, list) and carteira else None
-
-                if not first or not first.get("planos_contratados"):
-                    log.warning("⚠️ Cliente NÃO possui plano ativo — exclusão ignorada.")
-                    results.append({
-                        "cpf": cpf_digits,
-                        "status": "ignorado",
-                        "motivo": "Cliente sem plano ativo (exclusão)"
-                    })
-                    continue
-
-                pessoa = next((p for p in carteira if only_digits(p.get("cpf", "")) == cpf_digits), first)
-                id_plano = pessoa["planos_contratados"][0]["id_plano"]
-
-                plano = PLAN_MAPPING_JSON.get(str(id_plano))
-                if not plano:
-                    log.warning(f"⚠️ Plano {id_plano} não mapeado — exclusão ignorada.")
-                    results.append({
-                        "cpf": cpf_digits,
-                        "status": "ignorado",
-                        "motivo": f"plano {id_plano} não mapeado"
-                    })
-                    continue
-
-                # --------------------------
-                # Buscar matrícula na Medicar
-                # --------------------------
-                log.info("📡 Buscando matrícula (BBA_MATRIC) no Medicar...")
-                url_mat = f"{MEDICAR_BASE_URL}/client/v1/contract"
-                params_mat = {
-                    "cnpjmedicar": MEDICAR_CNPJMEDICAR,
-                    "grupoempresa": MEDICAR_GRUPOEMPRESA,
-                    "contrato": MEDICAR_CONTRATO,
-                    "cgcbeneficiario": cpf_digits,
-                }
+    if id_plano is None:
+        log.warning(f"⚠️ Cliente sem plano ativo{sufixo}")
+        motivo = "Cliente sem plano ativo (exclusão)" if exclusao else "Cliente sem plano ativo"
+        return {"cpf": cpf_digits, "status": "ignorado", "motivo": motivo}
 
-                resp_mat = await httpx_retry("GET", url_mat, headers={"Authorization": f"Bearer {token}"}, params=params_mat)
-                contr_data = resp_mat.json()
-
-                subscriber_id = contr_data.get("BBA_MATRIC")
-                log.info(f"📄 Matrícula encontrada: {subscriber_id}")
-
-                if not subscriber_id:
-                    log.warning("⚠️ Cliente ainda não possui matrícula — não há o que cancelar.")
-                    results.append({
-                        "cpf": cpf_digits,
-                        "status": "ignorado",
-                        "motivo": "Sem matrícula para cancelar"
-                    })
-                    continue
-
-                # --------------------------
-                # Cancelar matrícula
-                # --------------------------
-                log.info("🔥 Cancelando matrícula no Medicar...")
-                block_date = date.today().strftime("%Y-%m-%d")
-
-                resp_cancel = await medicar_encerrar_matricula(
-                    token=token,
-                    subscriber_id=subscriber_id,
-                    reason="000001",
-                    block_date=block_date,
-                    login_user="WEBHOOK DEPENDENTES (EXCLUSAO)"
-                )
+    if not PLAN_MAPPING_JSON.get(id_plano):
+        log.warning(f"⚠️ Plano {id_plano} não mapeado{sufixo}")
+        return {"cpf": cpf_digits, "status": "ignorado", "motivo": f"plano {id_plano} não mapeado"}
 
-                # --------------------------
-                # Salvar no banco
-                # --------------------------
-                log.info("🗄️ Salvando cliente como 'excluído' no banco...")
-                db_salvar_excluido(id_cliente=id_cliente, cpf=cpf_digits)
+    return None
 
-                log.info("✔️ MATRÍCULA CANCELADA COM SUCESSO!")
-                log.info("✔️ CLIENTE MARCADO COMO EXCLUÍDO NO BANCO")
+async def process_dependentes_item(item: dict, token: str, tenantid, contract_fields) -> dict:
+    """
+    Processa um item do webhook de dependentes (exclusão, reentrada ou
+    atualização). O item já passou por dependentes_pre_validar.
+    """
+    data = item.get("data") or {}
+    cpf = data.get("cpf")
+    id_cliente = data.get("id")
 
-                results.append({
-                    "cpf": cpf_digits,
-                    "status": "cancelado",
-                    "subscriberId": subscriber_id,
-                    "resultado": resp_cancel
-                })
-                continue
-
-            # =================================================================
-            # 🟢 3) STATUS = 1 → CLIENTE ATIVO — VERIFICAR SE É REENTRADA
-            # =================================================================
-            log.info("\n🟢 Cliente ativo — verificando se está em reentrada...")
-            excluido = db_buscar_excluido(id_cliente=id_cliente)
-
-            if excluido:
-                log.info("🔄 CLIENTE REATIVADO — Rodando fluxo de NOVO CLIENTE novamente")
-
-                result_item = await process_novo_cliente_item(
-                    item=item,
-                    token=token,
-                    tenantid=tenantid,
-                    contract_fields=contract_fields
-                )
+    cpf_digits = only_digits(cpf)
 
-                db_remover_excluido(id_cliente=id_cliente)
+    log.info("\n------------------------------")
+    log.info(f"👤 PROCESSANDO CLIENTE {id_cliente} | CPF {cpf_digits}")
+    log.info("------------------------------")
 
-                result_item["reentrada"] = True
-                results.append(result_item)
-                continue
+    try:
 
-            # =================================================================
-            # 4) FLUXO NORMAL → ATUALIZAR DEPENDENTES
-            # =================================================================
-            log.info("\n🟦 Fluxo normal: atualizando dependentes...")
+        # -----------------------------------------------------------------
+        # 1) BUSCAR CLIENTE + CONTATOS NO TENEX
+        # -----------------------------------------------------------------
+        log.info("📡 Buscando cliente no TENEX (com expand=contatos)...")
+        cliente_expand = await tenex_get_cliente_com_contatos(id_cliente)
 
-            # Verificar plano
-            log.info("📡 Verificando plano no TENEX...")
-            carteira = await tenex_get_carteira(cpf_digits)
-            first = carteira[0] if isinstance(carteira, list) and carteira else None
+        if not cliente_expand:
+            log.error("❌ Cliente não encontrado no TENEX")
+            return {
+                "cpf": cpf_digits,
+                "status": "erro",
+                "erro": "Cliente não encontrado no TENEX"
+            }
 
-            if not first or not first.get("planos_contratados"):
-                log.warning("⚠️ Cliente sem plano ativo — ignorado")
-                results.append({
-                    "cpf": cpf_digits,
-                    "status": "ignorado",
-                    "motivo": "Cliente sem plano ativo"
-                })
-                continue
+        status_tenex = cliente_expand.get("status")
+        contatos = cliente_expand.get("contatos", [])
 
-            pessoa = next((p for p in carteira if only_digits(p.get("cpf", "")) == cpf_digits), first)
-            id_plano = pessoa["planos_contratados"][0]["id_plano"]
+        log.info(f"📄 Status TENEX do cliente {id_cliente}: {status_tenex}")
+        log.info(f"📄 Total de contatos retornados: {len(contatos)}")
 
-            plano = PLAN_MAPPING_JSON.get(str(id_plano))
-            if not plano:
-                log.warning(f"⚠️ Plano {id_plano} não mapeado")
-                results.append({
-                    "cpf": cpf_digits,
-                    "status": "ignorado",
-                    "motivo": f"plano {id_plano} não mapeado"
-                })
-                continue
+
+        # =================================================================
+        # 🔴 2) STATUS = 2 → FLUXO DE EXCLUSÃO
+        # =================================================================
+        if status_tenex == 2:
+            log.info("\n🚨🚨🚨 CLIENTE INATIVO — INICIANDO FLUXO DE EXCLUSÃO 🚨🚨🚨\n")
+
+            # --------------------------
+            # Verificar plano
+            # --------------------------
+            log.info("📡 Verificando plano via carteira-virtual...")
+            ignorado = await dependentes_verificar_plano(cpf_digits, exclusao=True)
+            if ignorado:
+                return ignorado
 
             # --------------------------
-            # Montar dependentes
+            # Buscar matrícula na Medicar
             # --------------------------
-            log.info(f"📄 Montando dependentes encontrados nos contatos...")
-            dependentes_dicts = []
-            for dep in contatos:
-                if str(dep.get("principal")) != "0":
-                    continue
-                if not dep.get("cpf"):
-                    continue
-                dependentes_dicts.append({
-                    "nome": only_ascii_upper(dep.get("nome") or ""),
-                    "cpf": only_digits(dep.get("cpf") or ""),
-                    "data_nascimento": (dep.get("data_nascimento") or "").replace("-", ""),
-                    "sexo": str(dep.get("genero") or "2"),
-                    "nome_mae": "NOME MAE NAO INFORMADO",
-                })
-
-            log.info(f"📄 Total dependentes válidos: {len(dependentes_dicts)}")
-
-            if not dependentes_dicts:
-                log.warning("⚠️ Nenhum dependente encontrado")
-                results.append({
+            log.info("📡 Buscando matrícula (BBA_MATRIC) no Medicar...")
+            contr_data = await medicar_get_contract_by_cpf(token, cpf_digits)
+
+            subscriber_id = contr_data.get("BBA_MATRIC")
+            log.info(f"📄 Matrícula encontrada: {subscriber_id}")
+
+            if not subscriber_id:
+                log.warning("⚠️ Cliente ainda não possui matrícula — não há o que cancelar.")
+                return {
                     "cpf": cpf_digits,
                     "status": "ignorado",
-                    "motivo": "Nenhum dependente encontrado"
-                })
-                continue
+                    "motivo": "Sem matrícula para cancelar"
+                }
 
             # --------------------------
-            # Buscar matrícula
+            # Cancelar matrícula
             # --------------------------
-            log.info("📡 Buscando matrícula no Medicar...")
-            resp_mat = await httpx_retry(
-                "GET",
-                f"{MEDICAR_BASE_URL}/client/v1/contract",
-                headers={"Authorization": f"Bearer {token}"},
-                params={
-                    "cnpjmedicar": MEDICAR_CNPJMEDICAR,
-                    "grupoempresa": MEDICAR_GRUPOEMPRESA,
-                    "contrato": MEDICAR_CONTRATO,
-                    "cgcbeneficiario": cpf_digits,
-                }
+            log.info("🔥 Cancelando matrícula no Medicar...")
+            block_date = date.today().strftime("%Y-%m-%d")
+
+            resp_cancel = await medicar_encerrar_matricula(
+                token=token,
+                subscriber_id=subscriber_id,
+                reason="000001",
+                block_date=block_date,
+                login_user="WEBHOOK DEPENDENTES (EXCLUSAO)"
             )
+            medicar_esquecer_contrato(cpf_digits)
 
-            contr_data = resp_mat.json()
-            matricula = contr_data.get("BBA_MATRIC")
-            tenant_dep = contr_data.get("tenantid") or TENANT_ID
+            # --------------------------
+            # Salvar no banco
+            # --------------------------
+            log.info("🗄️ Salvando cliente como 'excluído' no banco...")
+            await asyncio.to_thread(db_salvar_excluido, id_cliente=id_cliente, cpf=cpf_digits)
 
-            log.info(f"📄 Matrícula: {matricula}")
+            log.info("✔️ MATRÍCULA CANCELADA COM SUCESSO!")
+            log.info("✔️ CLIENTE MARCADO COMO EXCLUÍDO NO BANCO")
 
-            if not matricula:
-                log.error("❌ Não foi possível obter matrícula no Medicar")
-                results.append({
-                    "cpf": cpf_digits,
-                    "status": "erro",
-                    "erro": "Sem BBA_MATRIC para atualização"
-                })
-                continue
+            return {
+                "cpf": cpf_digits,
+                "status": "cancelado",
+                "subscriberId": subscriber_id,
+                "resultado": resp_cancel
+            }
 
-            # --------------------------
-            # Atualizar dependentes
-            # --------------------------
-            log.info("👨‍👩‍👦 Atualizando dependentes no Medicar...")
-            resp_dep = await medicar_incluir_dependentes(
+        # =================================================================
+        # 🟢 3) STATUS = 1 → CLIENTE ATIVO — VERIFICAR SE É REENTRADA
+        # =================================================================
+        log.info("\n🟢 Cliente ativo — verificando se está em reentrada...")
+        excluido = await asyncio.to_thread(db_buscar_excluido, id_cliente=id_cliente)
+
+        if excluido:
+            log.info("🔄 CLIENTE REATIVADO — Rodando fluxo de NOVO CLIENTE novamente")
+
+            result_item = await process_novo_cliente_item(
+                item=item,
                 token=token,
-                tenantid=tenant_dep,
-                matricula=matricula,
-                dependentes=dependentes_dicts,
+                tenantid=tenantid,
+                contract_fields=contract_fields,
+                cliente_expand=cliente_expand
             )
 
-            log.info("✔️ Dependentes atualizados com sucesso.")
+            await asyncio.to_thread(db_remover_excluido, id_cliente=id_cliente)
+
+            result_item["reentrada"] = True
+            return result_item
 
-            results.append({
+        # =================================================================
+        # 4) FLUXO NORMAL → ATUALIZAR DEPENDENTES
+        # =================================================================
+        log.info("\n🟦 Fluxo normal: atualizando dependentes...")
+
+        # Verificar plano
+        log.info("📡 Verificando plano no TENEX...")
+        ignorado = await dependentes_verificar_plano(cpf_digits)
+        if ignorado:
+            return ignorado
+
+        # --------------------------
+        # Montar dependentes
+        # --------------------------
+        log.info(f"📄 Montando dependentes encontrados nos contatos...")
+        _, deps = separar_contatos(contatos)
+        dependentes = [Pessoa.from_contato(dep) for dep in deps]
+
+        log.info(f"📄 Total dependentes válidos: {len(dependentes)}")
+
+        if not dependentes:
+            log.warning("⚠️ Nenhum dependente encontrado")
+            return {
                 "cpf": cpf_digits,
-                "status": "dependentes_atualizados",
-                "dependentes": resp_dep,
-            })
+                "status": "ignorado",
+                "motivo": "Nenhum dependente encontrado"
+            }
 
-        except Exception as e:
-            log.exception(f"❌ ERRO ao processar CPF {cpf_digits}")
-            results.append({
+        # --------------------------
+        # Buscar matrícula
+        # --------------------------
+        log.info("📡 Buscando matrícula no Medicar...")
+        contr_data = await medicar_get_contract_by_cpf(token, cpf_digits)
+        matricula = contr_data.get("BBA_MATRIC")
+        tenant_dep = contr_data.get("tenantid") or TENANT_ID
+
+        log.info(f"📄 Matrícula: {matricula}")
+
+        if not matricula:
+            log.error("❌ Não foi possível obter matrícula no Medicar")
+            return {
                 "cpf": cpf_digits,
                 "status": "erro",
-                "erro": str(e),
-            })
+                "erro": "Sem BBA_MATRIC para atualização"
+            }
+
+        # --------------------------
+        # Atualizar dependentes
+        # --------------------------
+        log.info("👨‍👩‍👦 Atualizando dependentes no Medicar...")
+        resp_dep = await medicar_incluir_dependentes(
+            token=token,
+            tenantid=tenant_dep,
+            matricula=matricula,
+            dependentes=dependentes,
+        )
+
+        log.info("✔️ Dependentes atualizados com sucesso.")
+
+        return {
+            "cpf": cpf_digits,
+            "status": "dependentes_atualizados",
+            "dependentes": resp_dep,
+        }
+
+    except Exception as e:
+        log.exception(f"❌ ERRO ao processar CPF {cpf_digits}")
+        return {
+            "cpf": cpf_digits,
+            "status": "erro",
+            "erro": str(e),
+        }
+
+
+@app.post("/webhook/dependentes")
+async def webhook_dependentes(request: Request, response: Response, stream: bool = Query(False)):
+    """
+    stream=true → responde em NDJSON, uma linha por item assim que ele
+    termina ({"indice": posição no corpo, ...resultado}), sem esperar o lote.
+    """
+    try:
+        items = await webhook_itens(request)
+    except orjson.JSONDecodeError as e:
+        return webhook_json_invalido(e)
+
+    log.info("\n\n======================  📩 WEBHOOK DEPENDENTES RECEBIDO  ======================\n")
+    log.info("%d item(ns) recebido(s)", len(items))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(orjson.dumps(items, option=orjson.OPT_INDENT_2).decode())
+
+    # Itens inválidos/ignorados são resolvidos antes de qualquer chamada externa
+    results = [dependentes_pre_validar(item) for item in items]
+    validos = [i for i, r in enumerate(results) if r is None]
+    if not validos:
+        return {"status": "ok", "resultados": results}
+    if WEBHOOK_ASSINCRONO and not stream:
+        return await webhook_enfileirar("dependentes", items, results, response)
+
+    # -------------------------------------------------------------------------
+    # TOKEN MEDICAR
+    # -------------------------------------------------------------------------
+    try:
+        log.info("🔑 Obtendo token da Medicar...")
+        token = await medicar_get_token()
+        log.info("🔑 Token da Medicar obtido com sucesso.")
+    except Exception as e:
+        log.error("❌ ERRO ao obter token da Medicar")
+        return {"status": "erro", "mensagem": f"Erro obtendo token: {e}"}
+
+    tenantid = await medicar_resolve_tenantid(token)
+
+    contract_fields = CONTRACT_FIELDS
+
+    # Clientes diferentes são independentes → processa em paralelo, com limite de
+    # concorrência; itens do mesmo cliente seguem em ordem (cliente_lock)
+    sem = asyncio.Semaphore(max(1, WEBHOOK_CONCURRENCY))
+
+    async def worker(item: dict) -> dict:
+        async with cliente_lock(item), sem:
+            return await process_dependentes_item(
+                item=item,
+                token=token,
+                tenantid=tenantid,
+                contract_fields=contract_fields
+            )
+
+    if stream:
+        return StreamingResponse(
+            webhook_ndjson(results, {i: items[i] for i in validos}, worker),
+            media_type="application/x-ndjson"
+        )
+
+    processados = await asyncio.gather(*(worker(items[i]) for i in validos), return_exceptions=True)
+    for i, r in zip(validos, processados):
+        results[i] = {"status": "erro", "erro": str(r)} if isinstance(r, BaseException) else r
 
     log.info("\n======================  ✅ FIM DO WEBHOOK DEPENDENTES  ======================\n")
     return {"status": "ok", "resultados": results}
@@ -1042,32 +1928,44 @@ async def webhook_dependentes(request: Request):
 # ============================================================
 # ENDPOINT DE TESTE – incluir dependentes manualmente
 # ============================================================
+class DepItem(BaseModel):
+    nome: str
+    cpf: str
+    data_nascimento: str
+    sexo: Optional[int | str] = None  # 1/2 como nos contatos TENEX ou "1"/"2"; Pessoa.from_dict normaliza
+    nome_mae: Optional[str] = None
+
+class DepRequest(BaseModel):
+    cpf_titular: str
+    dependentes: List[DepItem]
+
 @app.post("/adicionar-dependentes")
 async def adicionar_dependentes(
-    cpf_titular: str = Query(...),
-    dependentes: str = Query(...)
+    req: Optional[DepRequest] = None,
+    cpf_titular: Optional[str] = Query(None),
+    dependentes: Optional[str] = Query(None)
 ):
-    cpf_digits = only_digits(cpf_titular)
+    """
+    Preferencial: corpo JSON (DepRequest). Mantém o formato antigo por query
+    string (cpf_titular + dependentes como JSON) para chamadas existentes.
+    """
+    if req is not None:
+        cpf_titular = req.cpf_titular
+        dependentes_list = [Pessoa.from_dict(d.model_dump()) for d in req.dependentes]
+    else:
+        if not cpf_titular or not dependentes:
+            return {"status": "erro", "mensagem": "Informe cpf_titular e dependentes"}
+        try:
+            dependentes_list = [Pessoa.from_dict(d) for d in orjson.loads(dependentes)]
+        except Exception:
+            return {"status": "erro", "mensagem": "JSON inválido"}
 
-    try:
-        dependentes_list = json.loads(dependentes)
-    except Exception:
-        return {"status": "erro", "mensagem": "JSON inválido"}
+    cpf_digits = only_digits(cpf_titular)
 
     token = await medicar_get_token()
 
     # Buscar matrícula
-    url = f"{MEDICAR_BASE_URL}/client/v1/contract"
-    headers = {"Authorization": f"Bearer {token}"}
-    params = {
-        "cnpjmedicar": MEDICAR_CNPJMEDICAR,
-        "grupoempresa": MEDICAR_GRUPOEMPRESA,
-        "contrato": MEDICAR_CONTRATO,
-        "cgcbeneficiario": cpf_digits
-    }
-
-    resp = await httpx_retry("GET", url, headers=headers, params=params)
-    contract = resp.json()
+    contract = await medicar_get_contract_by_cpf(token, cpf_digits)
 
     matricula = contract.get("BBA_MATRIC")
     tenantid = contract.get("tenantid")
@@ -1199,6 +2097,22 @@ async def cancelar_por_cpf(
         "detalhes": result
     }
 
+# ============================================================
+# MANUTENÇÃO – limpar caches em memória
+# ============================================================
+@app.post("/cache/limpar")
+async def cache_limpar():
+    """Descarta carteiras, matrículas, contrato padrão e tenant descoberto (o token é mantido)."""
+    carteiras = len(_carteira_cache)
+    _carteira_cache.clear()
+    _carteira_validadores.clear()
+    _matricula_cache.clear()
+    _contract_cache["data"] = None
+    _contract_cache["expiry"] = 0.0
+    _tenant_cache["tenantid"] = TENANT_ID
+    log.info(f"[CACHE] Caches limpos ({carteiras} carteira(s))")
+    return {"status": "ok", "carteiras_removidas": carteiras}
+
 # ============================================================
 # HEALTHCHECK
 # ============================================================